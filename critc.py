@@ -11,9 +11,23 @@ import json
 import asyncio
 import hashlib
 import os
+import shutil
 import random
 import time
 import base64  # encoding bytes to a string for JSON
+import struct  # packing numbers into bytes
+import itertools
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+import sys
+from array import array
+import multiprocessing
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
 
 # global values to simulate all clients having a synchronized current transaction and block
 curr_transaction_id = 0
@@ -32,18 +46,552 @@ PRINT_NEW_BLOCKS = False
 # log hashes
 PRINT_HASHES = False
 
+# print every block as it is added to the chain
+PRINT_BLOCKS = True
+
+# Stop once this many blocks have been added to the chain (not counting the
+# genesis block), or None to keep going until Ctrl-C.
+MAX_BLOCKS = None
+
+# If not None, blocks get made up timestamps, BLOCK_TIME + their ID, instead
+# of the time they were made. With random seeded too, every run then makes
+# exactly the same blocks (see critc_run.py).
+BLOCK_TIME = None
+
 # how many nibbles must be 0 at the beginning of the hash
 NIBBLES = 5
 
 # defines if there should be a delay for asynchronous operations
 DELAY = False
 
+# Write counts of what the miner is doing (hashes, how long mining and
+# logging take, how full the queues are) to this file every METRICS_INTERVAL
+# seconds, as "prometheus" text or "json", for something like Prometheus to
+# read (see critc_metrics.py). None turns them off, and then they cost
+# nothing.
+METRICS_PATH = None
+METRICS_FORMAT = "prometheus"
+METRICS_INTERVAL = 5.0
+
+# Profile each step of handling a block (mining, making the strings, logging)
+# for this many blocks with cProfile and tracemalloc, and write what was found
+# to the PROFILE_PATH directory (see critc_profile.py). None turns it off. The
+# CRITC_PROFILE and CRITC_PROFILE_PATH environment variables set them too, so
+# a run can be profiled without editing this file.
+PROFILE_BLOCKS = None
+PROFILE_PATH = "profile"
+
 # should the program log the blocks in their compressed string form to the file (True)
 # or as JSON (False)
 LOG_BLOCK_AS_STR = False
 
+# Should the program carry on from the chain left by the last run (True), or
+# delete it and start a new one (False)? Resuming needs the blocks to be in a
+# block store, or logged as JSON.
+RESUME = True
+
+# The file to save snapshots of the ledger and the next IDs in, and how many
+# blocks to mine between snapshots, so a restart does not have to go through
+# the whole chain (see critc_snapshot.py). Needs a block store.
+SNAPSHOT_PATH = "snapshot.json"
+SNAPSHOT_EVERY = 500
+
+# How often the log is flushed (see critc_log.LogWriter): "block" flushes
+# after every block, "group" after LOG_FLUSH_EVERY blocks or LOG_FLUSH_MS
+# milliseconds, whichever is first. Fewer flushes are faster, but more blocks
+# can be lost if the program crashes.
+LOG_FLUSH_POLICY = "group"
+LOG_FLUSH_EVERY = 16
+LOG_FLUSH_MS = 200
+
+# should every flush of the log also be written to the disk (fsync), so that
+# the log survives a power cut too
+LOG_FSYNC = False
+
+# the most log records that can wait to be written
+LOG_QUEUE_SIZE = 1024
+
+# The log is rotated once it has LOG_ROTATE_SIZE bytes or LOG_ROTATE_BLOCKS
+# blocks in it (either can be None): it is compressed with LOG_COMPRESSION
+# ("zlib" or "lzma") into a segment in the LOG_ARCHIVE_PATH directory, and
+# started again empty (see critc_log.LogArchive). LOG_ARCHIVE_PATH can be
+# None to never rotate the log.
+LOG_ARCHIVE_PATH = "blocks_archive"
+LOG_ROTATE_SIZE = 16 * 1024 * 1024
+LOG_ROTATE_BLOCKS = None
+LOG_COMPRESSION = "zlib"
+
+# the version number at the start of every block in the binary format
+BLOCK_FORMAT_VERSION = 1
+
+# one transaction inside a block in the binary format: id (8 bytes), sender
+# and receiver as positions in the block's name table (2 bytes each) and the
+# amount (8 bytes, signed), all big-endian
+TRANSACTION_RECORD = struct.Struct(">QHHq")
+
+# the directory to keep the indexed block store in (see critc_store.py),
+# or None to only log the blocks to blocks.log
+BLOCK_STORE_PATH = "blocks"
+
+# how many of the newest blocks to keep in memory when there is a block store
+CHAIN_WINDOW = 64
+
+# the file to keep the headers of the blocks in as well, for light clients
+# (see critc_headers.py), or None for no header file. Needs a block store.
+HEADERS_PATH = "headers.dat"
+
+# the directory to keep the transaction index in (see critc_index.py), or
+# None for no index, and how many blocks to add between saving it
+INDEX_PATH = "txindex"
+INDEX_FLUSH_EVERY = 100
+
+# the names that simulated transactions are made between
+NAMES = [
+    "John",
+    "James",
+    "Peter",
+    "Harry",
+    "Marcus",
+    "Adrian",
+    "Anna",
+    "Beatrice",
+    "Cindy",
+    "Diana",
+    "Eason",
+    "Francis",
+    "Gregory",
+    "Hannna",
+    "Ken",
+    "Elizabeth",
+    "Monty",
+    "Thomas",
+    "Samuel",
+]
+
+# For load testing: if not None, the transactions are made in batches of
+# this many by a TransactionGenerator (see critc_gen.py), which is a lot
+# faster than next_transaction. GENERATE_NUMPY picks whether it uses NumPy
+# (None uses it if it is installed; the two make different transactions).
+GENERATE_TRANSACTIONS = None
+GENERATE_NUMPY = None
+
+# the most transactions, batches of transactions and mined blocks that can
+# wait between the steps of the mining pipeline in main()
+TRANSACTION_QUEUE_SIZE = 1000
+BATCH_QUEUE_SIZE = 4
+MINED_QUEUE_SIZE = 16
+
+# the most transactions that can wait for a block, and how to pick which go
+# in a block: "amount" (biggest first) or "arrival" (first come first served)
+MEMPOOL_SIZE = 10000
+MEMPOOL_POLICY = "amount"
+
+# how many processes to use to mine a block. 1 mines on the current process
+# only, anything higher splits the proof of work search across a process pool.
+MINE_WORKERS = 1
+
+# how many proof of work values a worker process tries before it is given
+# another range to search
+MINE_CHUNK_SIZE = 100000
+
+# how many proof of work values a worker tries between checking if another
+# worker already found a (lower) answer
+MINE_CHECK_INTERVAL = 1024
+
+
+def write_atomic(path: str, data: str | bytes, fsync=True):
+    """
+    Write data to a file without ever leaving it half written: it is written
+    to a temporary file first, which is then renamed over the file (renaming
+    is atomic). With fsync, the data is on the disk before the rename.
+    """
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as fp:
+        fp.write(data)
+        if fsync:
+            fp.flush()
+            os.fsync(fp.fileno())
 
-@dataclass
+    os.replace(tmp_path, path)
+
+
+def int_to_bytes(num: int) -> bytes:
+    """
+    Encode a proof of work as it is stored in a block: 32 bytes, big-endian.
+    """
+
+    return num.to_bytes(32, "big")  # specify big-endian encoding
+
+
+def difficulty_mask(nibbles: int) -> tuple[int, int]:
+    """
+    Work out how to check that a digest starts with nibbles zero nibbles:
+    read the first n_bytes bytes of it as a number, and & it with mask.
+    The result is 0 if the digest is good enough. Returns (n_bytes, mask).
+    """
+
+    n_bytes = (nibbles + 1) // 2
+    n_bits = nibbles * 4
+    mask = ((1 << n_bits) - 1) << (n_bytes * 8 - n_bits)
+    return n_bytes, mask
+
+
+def meets_difficulty(digest: bytes, nibbles: int) -> bool:
+    """
+    Check if a raw digest starts with nibbles zero nibbles.
+    """
+
+    n_bytes, mask = difficulty_mask(nibbles)
+    return int.from_bytes(digest[:n_bytes], "big") & mask == 0
+
+
+class MiningEngine(ABC):
+    """
+    Base class for the loops that search for a proof of work.
+
+    An engine gets the encoded block header without the proof of work (base,
+    see BlockHeader.to_bytes), and searches the proof of work values from
+    start up to (but not including) stop for the lowest one where
+    sha256(base + int_to_bytes(pow)) starts with nibbles zero nibbles.
+    stop can be None to search forever.
+
+    should_stop is called with the current value every MINE_CHECK_INTERVAL
+    values; if it returns True the search gives up and returns None.
+
+    Every engine must return exactly the same values, so that they can be
+    swapped without changing any block.
+    """
+
+    name = ""
+
+    @abstractmethod
+    def search(
+        self,
+        base: bytes,
+        start: int,
+        stop: int | None,
+        nibbles: int,
+        should_stop=None,
+    ) -> int | None:
+        pass
+
+
+def _pow_values(start: int, stop: int | None):
+    if stop is None:
+        return itertools.count(start)  # counts up forever
+    return range(start, stop)
+
+
+class NaiveEngine(MiningEngine):
+    """
+    The original mining loop: hash the whole base again for every value and
+    compare the start of the hex digest against a string of zeros.
+    """
+
+    name = "naive"
+
+    def search(self, base, start, stop, nibbles, should_stop=None):
+        for pow in _pow_values(start, stop):
+            if should_stop is not None and (pow - start) % MINE_CHECK_INTERVAL == 0:
+                if should_stop(pow):
+                    return None
+
+            # get the bytes of the proof of work
+            pow_bytes = int_to_bytes(pow)
+
+            # guess the hash
+            potential_base = base + pow_bytes
+            guess_hash = hashlib.sha256(potential_base).hexdigest()
+
+            if pow % 10000 == 0 and PRINT_HASHES:
+                print(f"{pow}: {guess_hash}")
+
+            zeros = "0" * nibbles
+            if guess_hash[:nibbles] == zeros:
+                return pow
+
+        return None
+
+
+class MidstateEngine(MiningEngine):
+    """
+    A faster mining loop. The base never changes, so it is hashed once and
+    the state of the hasher is copied for every value, so only the 32 bytes
+    of the proof of work are hashed each time.
+
+    The digest is checked as raw bytes: the first (nibbles + 1) // 2 bytes are
+    read as a number and masked so only the bits of the leading nibbles are left.
+    """
+
+    name = "midstate"
+
+    def search(self, base, start, stop, nibbles, should_stop=None):
+        prefix = hashlib.sha256(base)  # the "midstate", hashed once
+
+        # work out the mask once instead of for every hash
+        n_bytes, mask = difficulty_mask(nibbles)
+        print_hashes = PRINT_HASHES
+
+        for pow in _pow_values(start, stop):
+            if should_stop is not None and (pow - start) % MINE_CHECK_INTERVAL == 0:
+                if should_stop(pow):
+                    return None
+
+            hasher = prefix.copy()
+            hasher.update(pow.to_bytes(32, "big"))
+            digest = hasher.digest()
+
+            if print_hashes and pow % 10000 == 0:
+                print(f"{pow}: {digest.hex()}")
+
+            if int.from_bytes(digest[:n_bytes], "big") & mask == 0:
+                return pow
+
+        return None
+
+
+# all the engines that can be picked by name
+MINING_ENGINES = {
+    NaiveEngine.name: NaiveEngine(),
+    MidstateEngine.name: MidstateEngine(),
+}
+
+# the engine Block.mine uses by default
+MINING_ENGINE = MidstateEngine.name
+
+
+def get_mining_engine(name: str | None = None) -> MiningEngine:
+    """
+    Look up a mining engine by name, or the default (MINING_ENGINE) if no
+    name is given.
+    """
+
+    if name is None:
+        name = MINING_ENGINE
+
+    try:
+        return MINING_ENGINES[name]
+    except KeyError:
+        raise ValueError(f"unknown mining engine: {name}")
+
+
+# The lowest proof of work found by any mining worker so far, or 0 if none
+# has been found yet (the search starts at 1). Each worker process gets the
+# same shared value from _init_mine_worker when the pool starts it.
+_mine_found = None
+
+
+def _init_mine_worker(found):
+    global _mine_found
+    _mine_found = found
+
+
+# The pool of worker processes mine_parallel mines on, as (pool, the value
+# shared with its workers, how many workers it has, the process it was made
+# in). It is made for the first block and kept for all the blocks after it.
+_mine_pool = None
+
+
+def _get_mine_pool(workers: int):
+    """
+    The pool for mine_parallel and the value shared with its workers. A new
+    one is only made if the number of workers changed, or in a new process
+    (a forked child can't use its parent's pool).
+    """
+
+    global _mine_pool
+
+    if _mine_pool is not None:
+        pool, found, pool_workers, pid = _mine_pool
+        if pid == os.getpid() and pool_workers == workers:
+            return pool, found
+        close_mine_pool()
+
+    found = multiprocessing.Value("Q", 0)  # unsigned 64-bit, shared between processes
+    pool = ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_mine_worker, initargs=(found,)
+    )
+    _mine_pool = (pool, found, workers, os.getpid())
+    return pool, found
+
+
+def close_mine_pool():
+    """
+    Stop the worker processes of mine_parallel, if it started any. A search
+    still running on them gives up.
+    """
+
+    global _mine_pool
+
+    if _mine_pool is None:
+        return
+    pool, found, _, pid = _mine_pool
+    _mine_pool = None
+
+    if pid != os.getpid():
+        return  # the parent's pool, which is not ours to stop
+
+    found.value = 1  # every range still running stops at its next check
+    pool.shutdown(cancel_futures=True)
+
+
+def _another_worker_found(pow: int) -> bool:
+    found = _mine_found.value
+    return found != 0 and found < pow
+
+
+def _mine_range(
+    base: bytes, start: int, stop: int, nibbles: int, engine: str
+) -> int | None:
+    """
+    Search the proof of work values in range(start, stop) inside a worker
+    process. Returns the lowest matching value in the range, or None if there
+    is none or if another worker already found a lower one.
+    """
+
+    pow = get_mining_engine(engine).search(
+        base, start, stop, nibbles, should_stop=_another_worker_found
+    )
+
+    if pow is not None:
+        # tell the other workers, but only if it is lower than what is there
+        with _mine_found.get_lock():
+            if _mine_found.value == 0 or pow < _mine_found.value:
+                _mine_found.value = pow
+
+    return pow
+
+
+def mine_parallel(
+    base: bytes, workers: int, nibbles: int, engine: str | None = None
+) -> int:
+    """
+    Find the proof of work for base using a pool of worker processes.
+
+    The proof of work values are split into ranges of MINE_CHUNK_SIZE, and
+    every worker searches its own range. As soon as one worker finds an answer,
+    the ranges after it are cancelled. The ranges before it still finish so
+    that the result is always the lowest answer, the same as mining on a
+    single process would give.
+
+    The pool is started once and used again for every block (see
+    close_mine_pool), so only one search can run on it at a time.
+    """
+
+    engine = get_mining_engine(engine).name  # fail early on a bad name
+
+    pool, found = _get_mine_pool(workers)
+    found.value = 0  # a new search, nothing found yet
+
+    pending = {}  # maps each running future to the start of its range
+    try:
+        next_start = 1
+        best = None
+
+        while True:
+            # keep every worker busy until an answer turns up
+            while best is None and len(pending) < workers:
+                stop = next_start + MINE_CHUNK_SIZE
+                future = pool.submit(
+                    _mine_range, base, next_start, stop, nibbles, engine
+                )
+                pending[future] = next_start
+                next_start = stop
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                res = future.result()
+                if res is not None and (best is None or res < best):
+                    best = res
+
+            # done once no range that could hold a lower answer is still running
+            if best is not None and all(start > best for start in pending.values()):
+                return best
+    finally:
+        # Stop the queued ranges, and make the running ones stop at their next
+        # check. They are waited for, so none of them is left to change the
+        # shared value during the next search.
+        found.value = 1
+        for future in pending:
+            future.cancel()
+        wait(pending)
+
+
+def find_pow(
+    base: bytes, nibbles: int, workers: int = 1, engine: str | None = None
+) -> int:
+    """
+    Find the proof of work for a header base (see Block.mine). This is a
+    function on its own so that it can be run in another process.
+    """
+
+    if workers > 1:
+        return mine_parallel(base, workers, nibbles, engine)
+
+    # start at 1 and search until a match is found
+    return get_mining_engine(engine).search(base, 1, None, nibbles)
+
+
+def encode_varint(num: int) -> bytes:
+    """
+    Encode a non-negative number in as few bytes as possible: 7 bits per
+    byte, lowest bits first, with the top bit set on every byte but the last.
+    Numbers below 128 take a single byte.
+    """
+
+    if num < 0:
+        raise ValueError("varints cannot be negative")
+
+    res = bytearray()
+    while num >= 0x80:
+        res.append((num & 0x7F) | 0x80)
+        num >>= 7
+    res.append(num)
+
+    return bytes(res)
+
+
+def decode_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """
+    Read a varint from data starting at pos.
+    Returns the number and the position just after it.
+    """
+
+    num = 0
+    shift = 0
+
+    while True:
+        byte = data[pos]
+        pos += 1
+        num |= (byte & 0x7F) << shift
+        if byte < 0x80:  # top bit clear, last byte
+            return num, pos
+        shift += 7
+
+
+# Zigzag encoding maps signed numbers to unsigned ones so that small
+# negative numbers still make small varints: 0, -1, 1, -2, 2 -> 0, 1, 2, 3, 4
+def zigzag(num: int) -> int:
+    return num * 2 if num >= 0 else -num * 2 - 1
+
+
+def unzigzag(num: int) -> int:
+    return num // 2 if num % 2 == 0 else -(num + 1) // 2
+
+
+def encode_str(s: str) -> bytes:
+    data = s.encode()
+    return encode_varint(len(data)) + data
+
+
+def decode_str(data: bytes, pos: int) -> tuple[str, int]:
+    length, pos = decode_varint(data, pos)
+    return bytes(data[pos : pos + length]).decode(), pos + length
+
+
+@dataclass(slots=True)  # slots: no __dict__ per transaction, which saves memory
 class Transaction:
     """
     Class to represent a transaction.
@@ -84,11 +632,266 @@ class Transaction:
         d = json.loads(data)
         return Transaction.from_dict(d)
 
+    def to_bytes(self) -> bytes:
+        """
+        Encode a transaction on its own in the binary format:
+        varint id, sender and receiver as length + UTF-8, zigzag varint amount.
+
+        Inside a block, Block.to_bytes uses fixed size records that share
+        one table of names instead.
+        """
+
+        return (
+            encode_varint(self.id)
+            + encode_str(self.sender)
+            + encode_str(self.receiver)
+            + encode_varint(zigzag(self.amount))
+        )
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "Transaction":
+        id, pos = decode_varint(data, 0)
+        sender, pos = decode_str(data, pos)
+        receiver, pos = decode_str(data, pos)
+        amount, pos = decode_varint(data, pos)
+        return Transaction(id, sender, receiver, unzigzag(amount))
+
+
+class TransactionBatch:
+    """
+    Class to hold many transactions compactly, in columns.
+
+    The IDs and amounts are kept in arrays of plain numbers, and the senders
+    and receivers as positions in a table of names, so each name is only
+    stored once. It works like a list of Transaction objects: it can be
+    looped over, indexed and appended to, and is equal to a list holding
+    the same transactions.
+
+    The Transaction objects are made when they are asked for, so changing
+    one does not change the batch.
+    """
+
+    __slots__ = ("ids", "senders", "receivers", "amounts", "names", "_positions")
+
+    def __init__(self, transactions=()):
+        self.ids = array("Q")
+        self.senders = array("I")  # positions in names
+        self.receivers = array("I")
+        self.amounts = array("q")
+        self.names: list[str] = []
+        self._positions: dict[str, int] = {}  # position of each name in names
+
+        for transaction in transactions:
+            self.append(transaction)
+
+    def name_position(self, name: str) -> int:
+        """
+        Get the position of a name in the name table, adding it if it is new.
+        """
+
+        pos = self._positions.get(name)
+        if pos is None:
+            pos = len(self.names)
+            self.names.append(sys.intern(name))
+            self._positions[name] = pos
+        return pos
+
+    def append(self, transaction: Transaction):
+        self.ids.append(transaction.id)
+        self.senders.append(self.name_position(transaction.sender))
+        self.receivers.append(self.name_position(transaction.receiver))
+        self.amounts.append(transaction.amount)
+
+    def _make(self, idx: int) -> Transaction:
+        return Transaction(
+            self.ids[idx],
+            self.names[self.senders[idx]],
+            self.names[self.receivers[idx]],
+            self.amounts[idx],
+        )
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._make(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("transaction batch index out of range")
+        return self._make(idx)
+
+    def __iter__(self):
+        names = self.names
+        for id, sender, receiver, amount in zip(
+            self.ids, self.senders, self.receivers, self.amounts
+        ):
+            yield Transaction(id, names[sender], names[receiver], amount)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, tuple, TransactionBatch)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"TransactionBatch({list(self)!r})"
+
+
+def merkle_leaf(transaction: Transaction) -> bytes:
+    """
+    Hash a transaction for the bottom row of a Merkle tree.
+
+    Leaves and inner nodes start with a different byte before hashing, so
+    an inner node can never be passed off as a transaction.
+    """
+
+    return hashlib.sha256(b"\x00" + str(transaction).encode()).digest()
+
+
+def merkle_node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+def merkle_levels(leaves: list[bytes]) -> list[list[bytes]]:
+    """
+    Build every row of a Merkle tree, from the leaves up to the root.
+
+    Pairs of hashes are hashed together to make the row above. If a row has
+    an odd number of hashes, the last one moves up to the next row as it is.
+    """
+
+    levels = [leaves]
+
+    while len(levels[-1]) > 1:
+        row = levels[-1]
+        above = [merkle_node(row[i], row[i + 1]) for i in range(0, len(row) - 1, 2)]
+        if len(row) % 2 == 1:
+            above.append(row[-1])  # the odd one out
+        levels.append(above)
+
+    return levels
+
+
+def merkle_root(leaves: list[bytes]) -> bytes:
+    """
+    Work out the root of the Merkle tree over leaves. An empty tree has the
+    hash of nothing as its root.
+    """
+
+    if len(leaves) == 0:
+        return hashlib.sha256(b"").digest()
+
+    return merkle_levels(leaves)[-1][0]
+
+
+def merkle_proof(leaves: list[bytes], index: int) -> list[tuple[bytes, bool]]:
+    """
+    Make a proof that leaves[index] is in the tree.
+
+    The proof is the list of hashes next to the path from the leaf to the
+    root, and if each of them goes on the left (True) or the right (False).
+    """
+
+    if index < 0 or index >= len(leaves):
+        raise IndexError("merkle proof index out of range")
+
+    proof = []
+    for row in merkle_levels(leaves)[:-1]:  # the root has no neighbour
+        sibling = index ^ 1  # flip the last bit: 0 <-> 1, 2 <-> 3, ...
+
+        # the odd one out has no neighbour and moves up unchanged
+        if sibling < len(row):
+            proof.append((row[sibling], sibling < index))
+
+        index //= 2
+
+    return proof
+
+
+def verify_merkle_proof(
+    transaction: Transaction, proof: list[tuple[bytes, bool]], root: bytes
+) -> bool:
+    """
+    Check that a transaction is in a block with only its Merkle root,
+    without needing any of the other transactions.
+    """
+
+    h = merkle_leaf(transaction)
+    for sibling, is_left in proof:
+        if is_left:
+            h = merkle_node(sibling, h)
+        else:
+            h = merkle_node(h, sibling)
+
+    return h == root
+
+
+# how a header is packed into bytes: big-endian ID (8 bytes), Merkle root
+# (32 bytes), timestamp as a double (8 bytes), previous hash (32 bytes) and
+# the proof of work (32 bytes)
+HEADER_FORMAT = ">Q32sd32s32s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  # 112 bytes
+
+# the header without the proof of work, which is what gets mined
+HEADER_BASE_SIZE = HEADER_SIZE - 32
+
+
+@dataclass
+class BlockHeader:
+    """
+    Class to represent the fixed size part of a block that is mined and hashed.
+
+    The transactions are only included through their Merkle root, so mining
+    and hashing cost the same no matter how many transactions a block has.
+    """
+
+    id: int
+    merkle_root: bytes
+    timestamp: float
+    prev_hash: bytes
+    pow: bytes
+
+    def to_bytes(self, include_pow=True) -> bytes:
+        """
+        Pack the header into HEADER_SIZE bytes, or HEADER_BASE_SIZE bytes
+        without the proof of work. Hashes shorter than 32 bytes (the empty
+        previous hash of the genesis block, or an unmined proof of work) are
+        padded with zero bytes.
+        """
+
+        res = struct.pack(
+            HEADER_FORMAT,
+            self.id,
+            self.merkle_root,
+            self.timestamp,
+            self.prev_hash,
+            self.pow,
+        )
+
+        if not include_pow:
+            res = res[:HEADER_BASE_SIZE]
+
+        return res
+
+    def hash(self) -> bytes:
+        return hashlib.sha256(self.to_bytes()).digest()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "BlockHeader":
+        id, root, timestamp, prev_hash, pow = struct.unpack(HEADER_FORMAT, data)
+        return BlockHeader(id, root, timestamp, prev_hash, pow)
+
 
 @dataclass
 class Block:
     """
     Class to model a block.
+
+    The string encoding and the hash are cached, as the same block is hashed
+    and encoded many times. Setting any field clears the caches, but changing
+    the transactions in place (e.g. transactions.append) does not, so call
+    invalidate() after doing that.
     """
 
     id: int
@@ -97,59 +900,97 @@ class Block:
     prev_hash: bytes
     pow: bytes  # proof of work
 
+    # cached to_str() (without the proof of work), Merkle root and hash(),
+    # None if not worked out yet. These are not fields, so the dataclass
+    # ignores them.
+    _str_cache = None
+    _merkle_cache = None
+    _hash_cache = None
+
+    def __setattr__(self, name: str, value):
+        object.__setattr__(self, name, value)
+
+        # a new proof of work only changes the hash, anything else changes both
+        if name == "pow":
+            object.__setattr__(self, "_hash_cache", None)
+        elif not name.startswith("_"):
+            self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget the cached encoding and hash.
+        """
+
+        object.__setattr__(self, "_str_cache", None)
+        object.__setattr__(self, "_merkle_cache", None)
+        object.__setattr__(self, "_hash_cache", None)
+
+    def merkle_root(self) -> bytes:
+        if self._merkle_cache is None:
+            leaves = [merkle_leaf(transaction) for transaction in self.transactions]
+            object.__setattr__(self, "_merkle_cache", merkle_root(leaves))
+
+        return self._merkle_cache
+
+    def merkle_proof(self, index: int) -> list[tuple[bytes, bool]]:
+        """
+        Make a proof that self.transactions[index] is in this block, which
+        can be checked with verify_merkle_proof and the block's Merkle root.
+        """
+
+        leaves = [merkle_leaf(transaction) for transaction in self.transactions]
+        return merkle_proof(leaves, index)
+
+    def header(self) -> BlockHeader:
+        return BlockHeader(
+            self.id, self.merkle_root(), self.timestamp, self.prev_hash, self.pow
+        )
+
     # brute force the hash
-    def mine(self):
-        # the function is only used inside this function,
-        # so just declare it inside
-        def int_to_bytes(num: int) -> bytes:
-            return num.to_bytes(32, "big")  # specify big-endian encoding
+    def mine(self, workers: int | None = None, engine: str | None = None):
+        """
+        Find the proof of work for the block. workers defaults to MINE_WORKERS,
+        and anything above 1 searches on that many processes in parallel.
+        engine is the name of the mining engine to use, see MINING_ENGINES.
+        """
 
         # if the proof of work is already mined and not empty, leave.
         if self.pow != bytes():
             return
 
-        # base as in the base data of the block without the POW
-        base = (
-            self.to_str() + "+"
-        )  # create a "{ <block contents> }+", ready to attatch the POW to
-        base = base.encode()
-        pow = 0
-        matching = False
+        if workers is None:
+            workers = MINE_WORKERS
 
-        while not matching:
-            pow += 1 # increment the proof of work to try another hash
+        # base as in the header of the block without the POW
+        base = self.header().to_bytes(include_pow=False)
 
-            # get the bytes of the proof of work
-            pow_bytes = int_to_bytes(pow)
+        self.pow = int_to_bytes(find_pow(base, NIBBLES, workers, engine))
 
-            # guess the hash
-            potential_base = base + pow_bytes
-            guess_hash = hashlib.sha256(potential_base).hexdigest()
+    def check_pow(self, nibbles: int | None = None) -> bool:
+        """
+        Check that the block is mined: its hash must start with nibbles
+        (NIBBLES by default) zero nibbles.
+        """
 
-            if pow % 10000 == 0 and PRINT_HASHES:
-                print(f"{pow}: {guess_hash}")
+        if nibbles is None:
+            nibbles = NIBBLES
+        return len(self.pow) != 0 and meets_difficulty(self.hash(), nibbles)
 
-            zeros = "0" * NIBBLES
-            if (
-                guess_hash[:NIBBLES] == zeros
-            ):  # first 3 bytes (6 nibbles, 24 bits) are 0
-                break
+    def hash(self) -> bytes:
+        if self._hash_cache is not None:
+            return self._hash_cache
 
-        self.pow = int_to_bytes(pow)
+        # only the header is hashed, the transactions are in it through the Merkle root
+        h = self.header().hash()
 
-    def hash(self) -> bytes:
-        h = self.to_str(include_pow=True)
-        h = bytes(
-            h, "utf-8"
-        )  # hashlib expects a ReadableBuffer which str does not implement (but bytes does)
-        h = hashlib.sha256(h).digest()  # digest at the end to get a bytes
+        object.__setattr__(self, "_hash_cache", h)
         return h
 
     # Functions to encode/serialize/deserialize the block
     # add include_pow as a kwarg to enable/disable adding the proof of work for mining
     def to_str(self, include_pow=False) -> str:
         """
-        Encodes a block to a string to calculate the proof of work.
+        Encodes a block to a string for logging.
         We can't use __str__ because we need a keyword argument, callers can
         choose between adding the proof of work to the end, like so:
 
@@ -160,6 +1001,21 @@ class Block:
         "{index;transactions;timestamp;previous hash}+proof of work"
         """
 
+        res = self._str_cache
+        if res is None:
+            res = self._encode()
+            object.__setattr__(self, "_str_cache", res)
+
+        if include_pow:
+            res += f"+{self.pow.hex()}}}"
+
+        return res
+
+    def _encode(self) -> str:
+        """
+        Build the string for to_str, without the proof of work.
+        """
+
         # start building transaction string
         transactions = "["
 
@@ -175,11 +1031,7 @@ class Block:
         transactions += "]"
 
         # build the string
-        res = f"{{{self.id};{transactions};{self.timestamp};{self.prev_hash.hex()}}}"
-        if include_pow:
-            res += f"+{self.pow.hex()}}}"
-
-        return res
+        return f"{{{self.id};{transactions};{self.timestamp};{self.prev_hash.hex()}}}"
 
     def to_dict(self) -> dict:
         d = {
@@ -191,7 +1043,7 @@ class Block:
                 "utf-8"
             ),  # encode it as a base64 object and immediately
             # chain the result to decode it into UTF-8
-            "pow": base64.b64encode(self.prev_hash).decode("utf-8"),
+            "pow": base64.b64encode(self.pow).decode("utf-8"),
             "timestamp": self.timestamp,
         }
         return d
@@ -220,6 +1072,111 @@ class Block:
         d = json.loads(data)
         return Block.from_dict(d)
 
+    def to_bytes(self) -> bytes:
+        """
+        Encode a block in the compact binary format, which is much smaller and
+        quicker to decode than JSON. Counts and lengths are varints:
+
+        - version (BLOCK_FORMAT_VERSION)
+        - id
+        - timestamp, 8 byte big-endian double
+        - flags byte: bit 0 set if there is a previous hash, bit 1 if there
+          is a proof of work (the genesis block and unmined blocks have none)
+        - previous hash and proof of work, 32 raw bytes each if present
+        - name table: count, then each name as length + UTF-8
+        - transaction count, then one fixed size record per transaction (see
+          TRANSACTION_RECORD): id, the sender's and receiver's positions in
+          the name table, and the amount
+
+        The transaction records are fixed size so they can all be unpacked
+        in one go, which is a lot faster than reading varints one by one.
+        """
+
+        flags = 0
+        if len(self.prev_hash) != 0:
+            flags |= 1
+        if len(self.pow) != 0:
+            flags |= 2
+
+        res = bytearray()
+        res += encode_varint(BLOCK_FORMAT_VERSION)
+        res += encode_varint(self.id)
+        res += struct.pack(">d", self.timestamp)
+        res.append(flags)
+        if flags & 1:
+            res += self.prev_hash
+        if flags & 2:
+            res += self.pow
+
+        # give every name a number, in the order they first show up
+        if isinstance(self.transactions, TransactionBatch):
+            names = self.transactions._positions  # already worked out
+        else:
+            names = {}
+            for transaction in self.transactions:
+                names.setdefault(transaction.sender, len(names))
+                names.setdefault(transaction.receiver, len(names))
+
+        if len(names) > 0xFFFF:
+            raise ValueError("too many names in one block for the binary format")
+
+        res += encode_varint(len(names))
+        for name in names:  # dicts keep the order names were added in
+            res += encode_str(name)
+
+        res += encode_varint(len(self.transactions))
+        for transaction in self.transactions:
+            res += TRANSACTION_RECORD.pack(
+                transaction.id,
+                names[transaction.sender],
+                names[transaction.receiver],
+                transaction.amount,
+            )
+
+        return bytes(res)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "Block":
+        version, pos = decode_varint(data, 0)
+        if version != BLOCK_FORMAT_VERSION:
+            raise ValueError(f"unsupported block format version: {version}")
+
+        id, pos = decode_varint(data, pos)
+        (timestamp,) = struct.unpack_from(">d", data, pos)
+        pos += 8
+        flags = data[pos]
+        pos += 1
+
+        prev_hash = bytes()
+        if flags & 1:
+            prev_hash = bytes(data[pos : pos + 32])
+            pos += 32
+        pow = bytes()
+        if flags & 2:
+            pow = bytes(data[pos : pos + 32])
+            pos += 32
+
+        name_count, pos = decode_varint(data, pos)
+        names = []
+        for _ in range(name_count):
+            name, pos = decode_str(data, pos)
+            names.append(name)
+
+        transaction_count, pos = decode_varint(data, pos)
+        end = pos + transaction_count * TRANSACTION_RECORD.size
+        records = list(TRANSACTION_RECORD.iter_unpack(data[pos:end]))
+
+        # the records are already in the form a TransactionBatch keeps them
+        transactions = TransactionBatch()
+        transactions.ids = array("Q", [record[0] for record in records])
+        transactions.senders = array("I", [record[1] for record in records])
+        transactions.receivers = array("I", [record[2] for record in records])
+        transactions.amounts = array("q", [record[3] for record in records])
+        for name in names:
+            transactions.name_position(name)
+
+        return Block(id, transactions, timestamp, prev_hash, pow)
+
 
 async def next_transaction(wait=True) -> Transaction:
     """
@@ -235,27 +1192,6 @@ async def next_transaction(wait=True) -> Transaction:
 
     global curr_transaction_id
 
-    NAMES = [
-        "John",
-        "James",
-        "Peter",
-        "Harry",
-        "Marcus",
-        "Adrian",
-        "Anna",
-        "Beatrice",
-        "Cindy",
-        "Diana",
-        "Eason",
-        "Francis",
-        "Gregory",
-        "Hannna",
-        "Ken",
-        "Elizabeth",
-        "Monty",
-        "Thomas",
-        "Samuel",
-    ]
     if wait or DELAY:
         await asyncio.sleep(random.randint(1, 3))
 
@@ -281,23 +1217,25 @@ async def next_transaction(wait=True) -> Transaction:
     return res
 
 
-async def next_block(prev_block: Block) -> Block:
+def block_timestamp(id: int) -> float:
     """
-    Function to simulate creating a new block.
-    In a real implementation, this would be a task run
-    on another node over the network,
+    The timestamp for a new block: the time now, or made up from its ID if
+    BLOCK_TIME is set.
     """
 
-    global curr_block_id
+    if BLOCK_TIME is None:
+        return time.time()
+    return BLOCK_TIME + id
 
-    if DELAY:
-        await asyncio.sleep(random.randint(1, 10))
 
-    transactions = []
-    for _ in range(BLOCK_CAP + 1):
-        # simulate waiting for the next block to come over from the network.
-        transactions.append(await next_transaction(wait=False))
-    timestamp = time.time()
+def seal_block(prev_block: Block, transactions: list[Transaction]) -> Block:
+    """
+    Make a new, unmined block after prev_block out of some transactions.
+    """
+
+    global curr_block_id
+
+    timestamp = block_timestamp(curr_block_id)
 
     # grab the hash of the previous block
     prev_hash = prev_block.hash()
@@ -305,6 +1243,9 @@ async def next_block(prev_block: Block) -> Block:
     id = curr_block_id
     curr_block_id += 1
 
+    # keep the transactions in columns, which takes a lot less memory
+    transactions = TransactionBatch(transactions)
+
     b = Block(id, transactions, timestamp, prev_hash, pow)
 
     if PRINT_NEW_BLOCKS:
@@ -312,69 +1253,504 @@ async def next_block(prev_block: Block) -> Block:
     return b
 
 
-async def main():
-    # Remove the log if it already exists.
-    os.remove("blocks.log")
+async def next_block(prev_block: Block) -> Block:
+    """
+    Function to simulate creating a new block.
+    In a real implementation, this would be a task run
+    on another node over the network,
+    """
+
+    if DELAY:
+        await asyncio.sleep(random.randint(1, 10))
 
-    # Open it
-    log = open("blocks.log", "a+")
+    transactions = []
+    for _ in range(BLOCK_CAP + 1):
+        # simulate waiting for the next block to come over from the network.
+        transactions.append(await next_transaction(wait=False))
 
-    try:
-        genesis_block = Block(
-        #  id,  Transactions,                         timestamp   prev_hash, pow    
-            0, [Transaction(0, "Jason", "James", 1)], time.time(), bytes(), bytes()
+    return seal_block(prev_block, transactions)
+
+
+def generate_transactions(generator, count: int) -> list[Transaction]:
+    """
+    Make count transactions with a TransactionGenerator (see critc_gen.py),
+    keeping its IDs in step with curr_transaction_id.
+    """
+
+    global curr_transaction_id
+
+    generator.next_id = curr_transaction_id
+    res = generator.batch(count)
+    curr_transaction_id = generator.next_id
+    return res
+
+
+async def produce_transactions(transactions: asyncio.Queue, generator=None):
+    """
+    Task to keep getting transactions and putting them in the queue.
+    Once the queue is full, this waits until the assembler takes some out.
+
+    With a generator, the transactions are made GENERATE_TRANSACTIONS at a
+    time by it instead of by next_transaction.
+    """
+
+    while True:
+        if generator is None:
+            await transactions.put(await next_transaction(wait=False))
+        else:
+            for transaction in generate_transactions(generator, GENERATE_TRANSACTIONS):
+                await transactions.put(transaction)
+
+        # next_transaction does not always wait, so give the other tasks a turn
+        await asyncio.sleep(0)
+
+
+async def assemble_blocks(
+    transactions: asyncio.Queue, batches: asyncio.Queue, mempool
+):
+    """
+    Task to move transactions from the queue into the mempool, and take the
+    best BLOCK_CAP + 1 of them out for a block whenever the miner has room
+    for another batch.
+
+    Once the mempool is full, no more transactions are taken from the queue
+    until the miner takes a batch. The queue then fills up and the producer
+    waits, instead of making transactions for the mempool to throw away.
+    """
+
+    while True:
+        if mempool.full():
+            await batches.put(mempool.select(BLOCK_CAP + 1))
+            continue
+
+        mempool.add(await transactions.get())
+
+        if len(mempool) >= BLOCK_CAP + 1 and not batches.full():
+            batches.put_nowait(mempool.select(BLOCK_CAP + 1))
+
+
+async def mine_blocks(
+    prev_block: Block,
+    batches: asyncio.Queue,
+    mined: asyncio.Queue,
+    executor,
+    metrics=None,
+    profiler=None,
+):
+    """
+    Task to turn batches of transactions into blocks and mine them.
+
+    Mining is done on the executor, so the event loop (and the other tasks)
+    keep running while a block is mined. Each block needs the hash of the
+    block before it, so they are mined one after the other.
+
+    With metrics (see critc_metrics.py), how long each block took to mine
+    and how many hashes it took are counted. With a profiler (see
+    critc_profile.py), mining is profiled on the executor.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    if metrics is not None:
+        from critc_metrics import ATTEMPT_BUCKETS
+
+        hashes = metrics.counter("hashes_total", "Hashes tried to mine blocks.")
+        hash_rate = metrics.gauge(
+            "hash_rate", "Hashes per second while mining the last block."
+        )
+        attempts = metrics.histogram(
+            "mine_attempts", "Hashes tried to mine each block.", ATTEMPT_BUCKETS
+        )
+        mine_time = metrics.histogram(
+            "mine_seconds", "Seconds taken to mine each block."
         )
-        genesis_block.mine()  # generate proof of work for the first block
 
-        # start the blockchain
-        blocks = [genesis_block]
+    while True:
+        batch = await batches.get()
+
+        if DELAY:
+            await asyncio.sleep(random.randint(1, 10))
+
+        new_block = seal_block(prev_block, batch)
+        base = new_block.header().to_bytes(include_pow=False)
+        start = time.perf_counter()
+        if profiler is not None and profiler.wants("mine"):
+            from critc_profile import profile_call
+
+            # With several workers, find_pow runs on a thread (which only
+            # waits for the workers), and memory can't be traced there.
+            pow, stats, allocations = await loop.run_in_executor(
+                executor,
+                profile_call,
+                find_pow,
+                (base, NIBBLES, MINE_WORKERS, MINING_ENGINE),
+                MINE_WORKERS == 1,
+            )
+            profiler.add("mine", stats, time.perf_counter() - start, allocations)
+        else:
+            pow = await loop.run_in_executor(
+                executor, find_pow, base, NIBBLES, MINE_WORKERS, MINING_ENGINE
+            )
+        new_block.pow = int_to_bytes(pow)
+
+        # The search starts at 1, so it tried pow values. This is worked out
+        # here instead of counted in the mining loop, so it does not slow it
+        # down. (With several workers, a few more values were tried above pow
+        # while the others stopped.)
+        if metrics is not None:
+            elapsed = time.perf_counter() - start
+            hashes.inc(pow)
+            attempts.observe(pow)
+            mine_time.observe(elapsed)
+            if elapsed > 0:
+                hash_rate.set(pow / elapsed)
+
+        await mined.put(new_block)
+        prev_block = new_block
+
+
+def _no_profile(stage: str):
+    return nullcontext()
+
+
+def log_record(block: Block) -> str:
+    """
+    The text that logs a block in blocks.log: a banner, then the block.
+    """
 
-        while True:
-            # save the previous block for easy access
-            prev_block = blocks[len(blocks) - 1]
-
-            # simulate waiting for a block to come over from the network.
-            new_block = await next_block(prev_block)
-            new_block.mine()
-
-            # Crash if the hashes do not match.
-            #
-            # In a real blockchain, the blockchain would simply be abandoned.
-            # However, this is just a simple demonstration project, meaning
-            # that keeping many of them is not needed.
-            if new_block.prev_hash != prev_block.hash():
-                print("hashes do not match. exiting...")
-
-            # add it to the blockchain
-            blocks.append(new_block)
+    # log JSON to the file by default to simulate sending over the network,
+    # but allow writing the string form too.
+    if LOG_BLOCK_AS_STR:
+        block_str = block.to_str(include_pow=True)
+    else:
+        block_str = block.to_json()
+
+    return f"Block {block.id}\n=====================\n{block_str}\n"
+
+
+async def persist_blocks(
+    blocks,
+    mined: asyncio.Queue,
+    log,
+    ledger,
+    index=None,
+    snapshots=None,
+    headers=None,
+    metrics=None,
+    profiler=None,
+):
+    """
+    Task to add mined blocks to the blockchain, update the balances in the
+    ledger and the transaction index (if there is one) and log them. With
+    snapshots, a snapshot is taken every so often, and with headers, the
+    header of every block is added to the header chain. With metrics, the
+    blocks and transactions added and how long it takes to turn each block
+    into its log record are counted, and with a profiler each step is
+    profiled.
+
+    It returns once MAX_BLOCKS blocks have been added, if it is not None.
+    """
 
-            # print it out to log it
-            print(f"{new_block.id}: {new_block.to_str(include_pow=True)}")
-    
-            # log JSON to the file by default to simulate sending over the network,
-            # but allow writing the string form too.
+    added = 0
 
-            if LOG_BLOCK_AS_STR:
+    # without a profiler, the steps are just run
+    stage = profiler.stage if profiler is not None else _no_profile
+
+    if metrics is not None:
+        block_count = metrics.counter("blocks_total", "Blocks added to the chain.")
+        transaction_count = metrics.counter(
+            "transactions_total", "Transactions in the blocks added to the chain."
+        )
+        serialize_time = metrics.histogram(
+            "serialize_seconds", "Seconds taken to make each block's log record."
+        )
+
+    while True:
+        new_block = await mined.get()
+
+        # save the previous block for easy access
+        prev_block = blocks[len(blocks) - 1]
+
+        # Crash if the hashes do not match.
+        #
+        # There is only one miner here, so there is only one branch, and a
+        # block that does not follow the last one is a bug. With several
+        # miners, the branches are kept in a BlockTree (see critc_tree.py).
+        if new_block.prev_hash != prev_block.hash():
+            print("hashes do not match. exiting...")
+            raise ValueError(
+                f"block {new_block.id} does not follow block {prev_block.id}"
+            )
+
+        # add it to the blockchain
+        with stage("apply"):
+            blocks.append(new_block)
+            ledger.apply_block(new_block)
+            if headers is not None:
+                headers.append(new_block.header())
+            if index is not None:
+                index.add_block(new_block)
+
+                # save the index every so often, not for every block
+                if new_block.id % INDEX_FLUSH_EVERY == 0:
+                    index.flush()
+
+            if snapshots is not None and snapshots.due(new_block.id):
+                snapshots.take(ledger, curr_transaction_id)
+
+        # print it out to log it
+        if PRINT_BLOCKS:
+            with stage("to_str"):
                 block_str = new_block.to_str(include_pow=True)
-            else:
-                block_str = new_block.to_json()
+            print(f"{new_block.id}: {block_str}")
+
+        start = time.perf_counter()
+        with stage("log_record"):
+            record = log_record(new_block)
+        if metrics is not None:
+            serialize_time.observe(time.perf_counter() - start)
 
-            # log the current block ID minus one, as it would have been
-            # incremented for the next block already.
-            log.write(f"Block {curr_block_id-1}\n=====================\n")
-            log.write(block_str)
-            log.write("\n")
+        # The log writer writes and flushes it on its own thread, so this
+        # does not wait for the disk.
+        with stage("log_write"):
+            log.write(record)
 
-            # File writing in python is done to a buffer.
-            # Flush flushes the contents of the buffer to the file, effectively
-            # saving changes.
-            log.flush()
+        if metrics is not None:
+            block_count.inc()
+            transaction_count.inc(len(new_block.transactions))
+
+        added += 1
+        if MAX_BLOCKS is not None and added >= MAX_BLOCKS:
+            return
+
+
+async def main():
+    # imported here, as critc_store and critc_chain import this file
+    from critc_store import BlockStore
+    from critc_index import TransactionIndex
+    from critc_mempool import Mempool
+    from critc_log import LogArchive, LogWriter
+    from critc_resume import resume_chain
+    from critc_snapshot import Snapshotter
+    from critc_headers import HeaderChain
+    from critc_metrics import Metrics, MetricsWriter
+    from critc_profile import StageProfiler, blocks_from_env, path_from_env
+    from critc_gen import TransactionGenerator
+
+    global curr_block_id, curr_transaction_id
+
+    # Empty the log if not resuming (creating it if it does not exist), and
+    # remove the old snapshot.
+    if not RESUME:
+        open("blocks.log", "w").close()
+        if SNAPSHOT_PATH is not None and os.path.exists(SNAPSHOT_PATH):
+            os.remove(SNAPSHOT_PATH)
+        if LOG_ARCHIVE_PATH is not None and os.path.exists(LOG_ARCHIVE_PATH):
+            shutil.rmtree(LOG_ARCHIVE_PATH)
+
+    # the compressed old parts of the log
+    archive = None
+    if LOG_ARCHIVE_PATH is not None:
+        archive = LogArchive(LOG_ARCHIVE_PATH, LOG_COMPRESSION)
+
+    # Open the block store (or none). If not resuming, the old one is deleted.
+    store = None
+    if BLOCK_STORE_PATH is not None:
+        store = BlockStore(BLOCK_STORE_PATH, fresh=not RESUME)
+
+    # the same for the transaction index
+    index = None
+    if INDEX_PATH is not None:
+        index = TransactionIndex(INDEX_PATH, fresh=not RESUME)
+
+    # the counters of what the program is doing, if they are turned on
+    metrics = None
+    if METRICS_PATH is not None:
+        metrics = Metrics()
+
+    # profile the first few blocks, if asked to
+    profiler = None
+    profile_blocks = blocks_from_env(PROFILE_BLOCKS)
+    if profile_blocks is not None:
+        profiler = StageProfiler(path_from_env(PROFILE_PATH), profile_blocks)
+
+    log = None
+    snapshots = None
+    headers = None
+    metrics_writer = None
+
+    try:
+        # Load the chain left by the last run, if any. Only the newest blocks
+        # are kept in memory, so memory use does not keep going up. The ledger keeps everyone's balance up to date as
+        # blocks are added. It comes from the last snapshot, if there is one.
+        resumed = resume_chain(
+            "blocks.log", store, index, CHAIN_WINDOW, SNAPSHOT_PATH, archive
+        )
+        blocks = resumed.blocks
+        ledger = resumed.ledger
+
+        # carry on with the IDs after the ones the chain used
+        curr_block_id = resumed.next_block_id
+        curr_transaction_id = resumed.next_transaction_id
+
+        # Open the header chain, and add any headers it is missing from the
+        # store. If it has headers the store does not (lost when the program
+        # stopped), it is made again from the store.
+        if store is not None and HEADERS_PATH is not None:
+            headers = HeaderChain(HEADERS_PATH, fresh=not RESUME, nibbles=NIBBLES)
+            if headers.tip_id() is not None and headers.tip_id() not in store:
+                headers.close()
+                headers = HeaderChain(HEADERS_PATH, fresh=True, nibbles=NIBBLES)
+            headers.sync_store(store)
+
+        # Open the log, with a thread to write to it
+        log = LogWriter(
+            open("blocks.log", "a+"),
+            LOG_FLUSH_POLICY,
+            LOG_FLUSH_EVERY,
+            LOG_FLUSH_MS,
+            LOG_FSYNC,
+            LOG_QUEUE_SIZE,
+            archive,
+            LOG_ROTATE_SIZE,
+            LOG_ROTATE_BLOCKS,
+            metrics,
+        )
+
+        tip = resumed.tip()
+        if tip is None:
+            genesis_block = Block(
+            #  id,             Transactions,                                           timestamp                        prev_hash, pow
+                curr_block_id, [Transaction(curr_transaction_id, "Jason", "James", 1)], block_timestamp(curr_block_id), bytes(), bytes()
+            )
+            genesis_block.mine()  # generate proof of work for the first block
+
+            # the genesis block used up the first block and transaction IDs
+            curr_block_id += 1
+            curr_transaction_id += 1
+
+            # Start the blockchain. The genesis block is logged too, so the
+            # chain can be read back from the log.
+            blocks.append(genesis_block)
+            ledger.apply_block(genesis_block)
+            if index is not None:
+                index.add_block(genesis_block)
+            if headers is not None:
+                headers.append(genesis_block.header())
+            log.write(log_record(genesis_block))
+
+            tip = genesis_block
+
+        # take a snapshot now, so the blocks just read do not have to be read
+        # again next time
+        if store is not None and SNAPSHOT_PATH is not None:
+            snapshots = Snapshotter(SNAPSHOT_PATH, store, index, SNAPSHOT_EVERY)
+            snapshots.take(ledger, curr_transaction_id)
+
+        # The blocks go through a pipeline of tasks, joined by queues:
+        #
+        #   produce_transactions -> assemble_blocks -> mine_blocks -> persist_blocks
+        #
+        # The queues have a maximum size, so if one step falls behind the
+        # steps before it wait for it instead of filling up memory. The
+        # assembler keeps the transactions waiting for a block in a mempool,
+        # which also has a maximum size.
+        transactions = asyncio.Queue(TRANSACTION_QUEUE_SIZE)
+        batches = asyncio.Queue(BATCH_QUEUE_SIZE)
+        mined = asyncio.Queue(MINED_QUEUE_SIZE)
+        mempool = Mempool(MEMPOOL_SIZE, MEMPOOL_POLICY)
+
+        # The generator is seeded from random, so seeding random (like
+        # critc_run.py does) makes the same transactions every run.
+        generator = None
+        if GENERATE_TRANSACTIONS is not None:
+            generator = TransactionGenerator(
+                random.getrandbits(64), use_numpy=GENERATE_NUMPY
+            )
+
+        # How full the queues are is only looked at when the metrics are
+        # written, so keeping it up to date costs nothing.
+        if metrics is not None:
+            metrics.gauge(
+                "transaction_queue_depth",
+                "Transactions waiting to go in the mempool.",
+                transactions.qsize,
+            )
+            metrics.gauge(
+                "batch_queue_depth", "Batches waiting to be mined.", batches.qsize
+            )
+            metrics.gauge(
+                "mined_queue_depth", "Mined blocks waiting to be added.", mined.qsize
+            )
+            metrics.gauge(
+                "mempool_size", "Transactions in the mempool.", mempool.__len__
+            )
+
+            metrics_writer = MetricsWriter(
+                metrics, METRICS_PATH, METRICS_FORMAT, METRICS_INTERVAL
+            )
+
+        # Mining is done on another process, so it does not hold up the event
+        # loop. With several mining workers, mine_parallel keeps its own pool
+        # of processes and only needs a thread to wait on them.
+        if MINE_WORKERS > 1:
+            executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            executor = ProcessPoolExecutor(max_workers=1)
+
+        tasks = [
+            asyncio.ensure_future(produce_transactions(transactions, generator)),
+            asyncio.ensure_future(assemble_blocks(transactions, batches, mempool)),
+            asyncio.ensure_future(
+                mine_blocks(tip, batches, mined, executor, metrics, profiler)
+            ),
+            asyncio.ensure_future(
+                persist_blocks(
+                    blocks,
+                    mined,
+                    log,
+                    ledger,
+                    index,
+                    snapshots,
+                    headers,
+                    metrics,
+                    profiler,
+                )
+            ),
+        ]
 
-    # Error handling for Ctrl-C and to close the file despite all errors
+        try:
+            # Only persist_blocks ever returns (after MAX_BLOCKS blocks), the
+            # others run until they are stopped, or fail.
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()  # raises the error the task failed with, if any
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            close_mine_pool()
+
+    # Error handling for Ctrl-C and to close the file despite all errors.
+    # Closing the log writer waits for it to write everything it was sent.
     except KeyboardInterrupt or EOFError:
-        log.close()
+        pass  # everything is closed below
     finally:
-        log.close()
+        # a last snapshot, so the next run can start straight away
+        if snapshots is not None:
+            snapshots.take(ledger, curr_transaction_id, wait=True)
+        if log is not None:
+            log.close()
+        if store is not None:
+            store.close()
+        if index is not None:
+            index.close()
+        if headers is not None:
+            headers.close()
+        if metrics_writer is not None:
+            metrics_writer.close()  # writes them one last time
+        if profiler is not None:
+            profiler.close()  # writes what was found, if not written yet
 
 
 if __name__ == "__main__":
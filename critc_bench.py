@@ -0,0 +1,316 @@
+# Micro-benchmarks for the block operations in critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Run with:
+#
+#   python critc_bench.py --out before.json
+#   python critc_bench.py --out after.json --compare before.json
+#
+# Every input is generated from a seeded random number generator, so two runs
+# with the same arguments benchmark exactly the same blocks.
+
+import argparse
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+import critc
+
+# the time to keep repeating an operation for, in seconds
+MIN_TIME = 0.2
+
+
+def make_transactions(rng: random.Random, count: int, first_id=0) -> list:
+    """
+    Make count transactions between random (but different) people.
+    """
+
+    res = []
+    for i in range(count):
+        sender, receiver = rng.sample(critc.NAMES, 2)  # never the same person
+        res.append(critc.Transaction(first_id + i, sender, receiver, rng.randint(0, 200)))
+    return res
+
+
+def make_block(rng: random.Random, block_id: int, block_cap: int) -> critc.Block:
+    """
+    Make an unmined block with block_cap + 1 transactions, like next_block does.
+    """
+
+    transactions = make_transactions(rng, block_cap + 1, block_id * (block_cap + 1))
+    timestamp = 1700000000.0 + block_id  # fixed, so the hashes are reproducible
+    prev_hash = rng.randbytes(32)
+    return critc.Block(block_id, transactions, timestamp, prev_hash, bytes())
+
+
+def time_op(fn, min_time=MIN_TIME) -> tuple[int, float]:
+    """
+    Call fn over and over for at least min_time seconds.
+    Returns how many times it was called and how long that took.
+    """
+
+    ops = 0
+    batch = 1
+    start = time.perf_counter()
+    elapsed = 0.0
+
+    while elapsed < min_time:
+        for _ in range(batch):
+            fn()
+        ops += batch
+        batch *= 2  # double up so the clock is not read every call
+        elapsed = time.perf_counter() - start
+
+    return ops, elapsed
+
+
+def alloc_op(fn, ops=50) -> tuple[float, float]:
+    """
+    Measure the memory one call of fn allocates, with tracemalloc.
+    This is done separately from the timing, as tracemalloc slows everything down.
+
+    Returns the average number of allocations per call and the average peak
+    number of bytes used during a call. What each call returns is kept until
+    the end, so the allocations it is made of are counted. Memory a call
+    allocates and frees again before returning only shows in the peak.
+    """
+
+    # leave out what this file and tracemalloc allocate, like the results list
+    filters = [
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ]
+
+    tracemalloc.start()
+    try:
+        results = []
+        peak_total = 0
+        before = tracemalloc.take_snapshot()
+        for _ in range(ops):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            results.append(fn())
+            _, peak = tracemalloc.get_traced_memory()
+            peak_total += peak - current
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    stats = after.filter_traces(filters).compare_to(
+        before.filter_traces(filters), "filename"
+    )
+    allocations = sum(stat.count_diff for stat in stats)
+    return allocations / ops, peak_total / ops
+
+
+def bench(name: str, fn, **params) -> dict:
+    """
+    Time and measure the memory use of fn, and make a result record.
+    """
+
+    ops, elapsed = time_op(fn)
+    allocations, alloc_peak = alloc_op(fn)
+
+    res = {"bench": name}
+    res.update(params)
+    res["ops"] = ops
+    res["seconds"] = elapsed
+    res["ops_per_sec"] = ops / elapsed
+    res["allocations_per_op"] = allocations
+    res["alloc_peak_bytes_per_op"] = alloc_peak
+    return res
+
+
+def bench_serialization(rng: random.Random, block_cap: int) -> list[dict]:
+    """
+    Benchmark everything that does not depend on the difficulty.
+    """
+
+    block = make_block(rng, 1, block_cap)
+    block.mine()
+    block_json = block.to_json()
+    block_bytes = block.to_bytes()
+    transaction = block.transactions[0]
+
+    def cold(fn):
+        # A block caches its encoding and hash, so without forgetting them
+        # first only the cache lookup would be timed.
+        def run():
+            block.invalidate()
+            return fn()
+
+        return run
+
+    return [
+        bench("Block.hash", block.hash, block_cap=block_cap),
+        bench("Block.hash (cold)", cold(block.hash), block_cap=block_cap),
+        bench("Block.to_str", block.to_str, block_cap=block_cap),
+        bench("Block.to_str (cold)", cold(block.to_str), block_cap=block_cap),
+        bench(
+            "Block.to_str(include_pow)",
+            lambda: block.to_str(include_pow=True),
+            block_cap=block_cap,
+        ),
+        bench(
+            "Block.to_str(include_pow) (cold)",
+            cold(lambda: block.to_str(include_pow=True)),
+            block_cap=block_cap,
+        ),
+        bench("Block.to_json", block.to_json, block_cap=block_cap),
+        bench(
+            "Block.from_json",
+            lambda: critc.Block.from_json(block_json),
+            block_cap=block_cap,
+        ),
+        bench("Block.to_bytes", block.to_bytes, block_cap=block_cap),
+        bench(
+            "Block.from_bytes",
+            lambda: critc.Block.from_bytes(block_bytes),
+            block_cap=block_cap,
+        ),
+        bench("Transaction.to_dict", transaction.to_dict, block_cap=block_cap),
+    ]
+
+
+def bench_mine(
+    rng: random.Random, block_cap: int, nibbles: int, blocks: int, engine: str
+) -> dict:
+    """
+    Mine a number of blocks and measure the blocks and hashes per second.
+    Mining time depends a lot on luck, so several blocks are averaged.
+    """
+
+    to_mine = [make_block(rng, i, block_cap) for i in range(blocks)]
+
+    old_nibbles = critc.NIBBLES
+    critc.NIBBLES = nibbles
+    try:
+        start = time.perf_counter()
+        for block in to_mine:
+            block.mine(workers=1, engine=engine)
+        elapsed = time.perf_counter() - start
+    finally:
+        critc.NIBBLES = old_nibbles
+
+    # the search starts at 1, so the proof of work is the number of hashes tried
+    hashes = sum(int.from_bytes(block.pow, "big") for block in to_mine)
+
+    return {
+        "bench": "Block.mine",
+        "block_cap": block_cap,
+        "nibbles": nibbles,
+        "engine": engine,
+        "ops": blocks,
+        "seconds": elapsed,
+        "ops_per_sec": blocks / elapsed,
+        "hashes": hashes,
+        "hashes_per_sec": hashes / elapsed,
+    }
+
+
+def run(args) -> dict:
+    results = []
+
+    for block_cap in args.caps:
+        # a new generator for every configuration, so adding or removing one
+        # does not change the inputs of the others
+        rng = random.Random(f"{args.seed}-{block_cap}")
+        results.extend(bench_serialization(rng, block_cap))
+
+        for nibbles in args.nibbles:
+            for engine in args.engines:
+                rng = random.Random(f"{args.seed}-{block_cap}-{nibbles}")
+                results.append(
+                    bench_mine(rng, block_cap, nibbles, args.mine_blocks, engine)
+                )
+
+    return {
+        "meta": {
+            "seed": args.seed,
+            "caps": args.caps,
+            "nibbles": args.nibbles,
+            "engines": args.engines,
+            "mine_blocks": args.mine_blocks,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def result_key(result: dict) -> tuple:
+    return (
+        result["bench"],
+        result.get("block_cap"),
+        result.get("nibbles"),
+        result.get("engine"),
+    )
+
+
+def compare(old: dict, new: dict):
+    """
+    Print how much faster (above 1.00x) or slower the new run is for every
+    benchmark the two runs have in common.
+    """
+
+    old_results = {result_key(r): r for r in old["results"]}
+
+    for result in new["results"]:
+        key = result_key(result)
+        if key not in old_results:
+            continue
+
+        ratio = result["ops_per_sec"] / old_results[key]["ops_per_sec"]
+        name = " ".join(str(part) for part in key if part is not None)
+        print(f"{name:<50} {ratio:6.2f}x")
+
+
+def int_list(s: str) -> list[int]:
+    return [int(part) for part in s.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the critc.py blocks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--caps", type=int_list, default=[1, 20, 100], help="BLOCK_CAP values, comma separated"
+    )
+    parser.add_argument(
+        "--nibbles", type=int_list, default=[2, 3, 4], help="NIBBLES values, comma separated"
+    )
+    parser.add_argument(
+        "--engines",
+        type=lambda s: s.split(","),
+        default=list(critc.MINING_ENGINES),
+        help="mining engines, comma separated",
+    )
+    parser.add_argument(
+        "--mine-blocks", type=int, default=5, help="blocks to mine per configuration"
+    )
+    parser.add_argument("--out", help="file to write the JSON results to (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    report = run(args)
+    report_json = json.dumps(report, indent=4)
+
+    if args.out is None:
+        print(report_json)
+    else:
+        with open(args.out, "w") as fp:
+            fp.write(report_json)
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            compare(json.load(fp), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# A blockchain that only keeps its newest blocks in memory
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+
+import collections
+
+from critc import Block
+from critc_store import BlockStore
+
+# how many of the newest blocks to keep in memory
+CHAIN_WINDOW = 64
+
+
+class Chain:
+    """
+    Class to hold a blockchain without keeping all of it in memory.
+
+    Every block is written to a BlockStore, but only the newest window blocks
+    are kept in memory; older ones are read back from the store when they are
+    asked for. It can be used like the list of blocks it replaces:
+
+        chain.append(block)
+        prev_block = chain[len(chain) - 1]  # or chain[-1]
+    """
+
+    def __init__(self, store: BlockStore, window=CHAIN_WINDOW):
+        if window < 1:
+            raise ValueError("the chain window must hold at least one block")
+
+        self.store = store
+
+        # the newest blocks, oldest first. Once it is full, adding a block to
+        # the end drops the oldest one from the start.
+        self._recent = collections.deque(maxlen=window)
+
+        # fill the window if the store already has blocks
+        for position in range(max(len(store) - window, 0), len(store)):
+            self._recent.append(store.get_at(position))
+
+    def append(self, block: Block):
+        self.store.append(block)
+        self._recent.append(block)
+
+    def tip(self) -> Block | None:
+        """
+        Get the newest block, or None if the chain is empty.
+        """
+
+        if len(self._recent) == 0:
+            return None
+        return self._recent[-1]
+
+    def get(self, id: int) -> Block:
+        """
+        Get a block by its ID. Raises KeyError if it is not in the chain.
+        """
+
+        # the IDs in the window normally go up by one, so work out where it
+        # would be, and only check that one block
+        if len(self._recent) > 0:
+            idx = len(self._recent) - 1 - (self._recent[-1].id - id)
+            if 0 <= idx < len(self._recent) and self._recent[idx].id == id:
+                return self._recent[idx]
+
+        return self.store.get(id)
+
+    def __getitem__(self, position: int) -> Block:
+        """
+        Get the block at a position in the chain, like a list does.
+        """
+
+        if position < 0:
+            position += len(self)
+        if position < 0 or position >= len(self):
+            raise IndexError("chain index out of range")
+
+        # position of the oldest block in the window
+        first_recent = len(self) - len(self._recent)
+        if position >= first_recent:
+            return self._recent[position - first_recent]
+
+        return self.store.get_at(position)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
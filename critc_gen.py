@@ -0,0 +1,164 @@
+# Fast, seeded generation of fake transactions for load testing critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# next_transaction in critc.py makes one transaction at a time, which is far
+# too slow to load test with. This makes a whole batch at once, as columns of
+# numbers, using NumPy if it is installed and plain Python if it is not.
+#
+# Run it on its own to see how fast it is:
+#
+#   python critc_gen.py --count 1000000 --seed 1
+#
+# To feed its transactions through the whole pipeline of critc.py, set
+# GENERATE_TRANSACTIONS there, or run:
+#
+#   python critc_run.py --blocks 200 --generate 1000
+
+import argparse
+import random
+import time
+from array import array
+
+import critc
+from critc import Transaction
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+# the largest amount in a generated transaction (the smallest is 0),
+# the same as next_transaction
+MAX_AMOUNT = 200
+
+
+class TransactionGenerator:
+    """
+    Class to make batches of random transactions.
+
+    The same seed always gives the same transactions (but NumPy and plain
+    Python give different ones). IDs carry on from one batch to the next.
+    """
+
+    def __init__(
+        self,
+        seed=None,
+        names: list[str] | None = None,
+        first_id=0,
+        use_numpy: bool | None = None,
+    ):
+        """
+        use_numpy picks whether to use NumPy. By default it is used if it is
+        installed.
+        """
+
+        if names is None:
+            names = critc.NAMES
+        if len(names) < 2:
+            raise ValueError("at least two names are needed to make transactions")
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        if use_numpy and numpy is None:
+            raise ValueError("NumPy is not installed")
+
+        self.names = names
+        self.next_id = first_id
+        self.use_numpy = use_numpy
+
+        if use_numpy:
+            self._rng = numpy.random.default_rng(seed)
+        else:
+            self._rng = random.Random(seed)
+
+    def columns(self, count: int) -> tuple:
+        """
+        Make count transactions as four columns: the IDs, the senders and
+        receivers (as positions in self.names) and the amounts.
+
+        The columns are NumPy arrays, or array.arrays without NumPy.
+        """
+
+        first_id = self.next_id
+        self.next_id += count
+        n_names = len(self.names)
+
+        # Each receiver is the sender moved along by 1 to n_names - 1 places
+        # (wrapping around), which picks any other name evenly and can never
+        # pick the sender, so there is no need to try again like
+        # next_transaction does.
+        if self.use_numpy:
+            rng = self._rng
+            ids = numpy.arange(first_id, first_id + count, dtype=numpy.uint64)
+            senders = rng.integers(0, n_names, count)
+            receivers = (senders + rng.integers(1, n_names, count)) % n_names
+            amounts = rng.integers(0, MAX_AMOUNT + 1, count, dtype=numpy.int64)
+            return (
+                ids,
+                senders.astype(numpy.uint16),
+                receivers.astype(numpy.uint16),
+                amounts,
+            )
+
+        rng = self._rng
+        ids = array("Q", range(first_id, first_id + count))
+        senders = array("H", rng.choices(range(n_names), k=count))
+        moves = rng.choices(range(1, n_names), k=count)
+        receivers = array(
+            "H", [(sender + move) % n_names for sender, move in zip(senders, moves)]
+        )
+        amounts = array("q", rng.choices(range(MAX_AMOUNT + 1), k=count))
+        return ids, senders, receivers, amounts
+
+    def batch(self, count: int) -> list[Transaction]:
+        """
+        Make count transactions as Transaction objects.
+        """
+
+        ids, senders, receivers, amounts = self.columns(count)
+        names = self.names
+
+        if self.use_numpy:
+            # turn them into Python ints first, as NumPy ints are slow to use one by one
+            ids, senders, receivers, amounts = (
+                ids.tolist(),
+                senders.tolist(),
+                receivers.tolist(),
+                amounts.tolist(),
+            )
+
+        return [
+            Transaction(id, names[sender], names[receiver], amount)
+            for id, sender, receiver, amount in zip(ids, senders, receivers, amounts)
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time the transaction generator")
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-numpy", action="store_true", help="use plain Python")
+    parser.add_argument(
+        "--objects", action="store_true", help="make Transaction objects, not just columns"
+    )
+    args = parser.parse_args()
+
+    use_numpy = False if args.no_numpy else None
+    gen = TransactionGenerator(args.seed, use_numpy=use_numpy)
+
+    start = time.perf_counter()
+    if args.objects:
+        gen.batch(args.count)
+    else:
+        gen.columns(args.count)
+    elapsed = time.perf_counter() - start
+
+    backend = "numpy" if gen.use_numpy else "python"
+    print(f"{args.count} transactions in {elapsed:.3f}s ({backend}): {args.count / elapsed:,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+# A chain of block headers only, for a light client of critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Run with:
+#
+#   python critc_headers.py headers.dat                 (check the headers)
+#   python critc_headers.py headers.dat --from blocks   (add a store's headers first)
+#
+# A block header (see BlockHeader in critc.py) is all that is needed to check
+# that a block is mined and follows the block before it: the transactions are
+# only in it through their Merkle root. So a light client only keeps the
+# headers, and gets the body of a block (its transactions) from a full node's
+# block store when it needs one.
+#
+# The headers are kept in one file: a small file header, then one fixed size
+# record per block. The ID of each block is worked out from its position, and
+# the proof of work is kept as an 8 byte number instead of 32 bytes, so each
+# record is 80 bytes, and a million headers are 80 MB.
+
+import argparse
+import collections
+import hashlib
+import os
+import struct
+import sys
+import time
+
+import critc
+from critc import (
+    HEADER_FORMAT,
+    Block,
+    BlockHeader,
+    Transaction,
+    int_to_bytes,
+    verify_merkle_proof,
+)
+from critc_store import BlockStore
+from critc_validate import ValidationResult
+
+# the start of the file: magic bytes, format version and the ID of the first block
+HEADERS_FILE_HEADER = struct.Struct(">4sBQ")
+HEADERS_MAGIC = b"CHDR"
+HEADERS_VERSION = 1
+
+# one header: Merkle root, timestamp, previous hash and proof of work
+HEADER_RECORD = struct.Struct(">32sd32sQ")
+
+# how many headers to read from the file at a time when going through it
+READ_HEADERS = 4096
+
+# how many block bodies a light client keeps in memory
+BODY_CACHE_SIZE = 64
+
+
+class HeaderChain:
+    """
+    Class to keep the headers of a blockchain in a file, checking each one
+    as it is added.
+    """
+
+    def __init__(
+        self, path: str, fresh=False, read_only=False, nibbles: int | None = None
+    ):
+        if nibbles is None:
+            nibbles = critc.NIBBLES
+
+        self.path = path
+        self.read_only = read_only
+        self.nibbles = nibbles
+
+        if fresh and not read_only and os.path.exists(path):
+            os.remove(path)
+
+        if read_only:
+            self._fp = open(path, "rb")
+        else:
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            self._fp = open(path, "r+b")
+
+        self.first_id = None
+        self._count = 0
+        # the hash the next header must follow. The first block has no
+        # previous hash, which is packed as 32 zero bytes.
+        self._tip_hash = bytes(32)
+
+        size = self._fp.seek(0, os.SEEK_END)
+        if size >= HEADERS_FILE_HEADER.size:
+            self._fp.seek(0)
+            magic, version, first_id = HEADERS_FILE_HEADER.unpack(
+                self._fp.read(HEADERS_FILE_HEADER.size)
+            )
+            if magic != HEADERS_MAGIC or version != HEADERS_VERSION:
+                raise ValueError(f"{path} is not a header chain")
+
+            self.first_id = first_id
+
+            # drop a header that was only partly written
+            self._count = (size - HEADERS_FILE_HEADER.size) // HEADER_RECORD.size
+            if not read_only:
+                self._fp.truncate(self._record_offset(self._count))
+
+            if self._count > 0:
+                self._tip_hash = self.get_at(self._count - 1).hash()
+
+    def _record_offset(self, position: int) -> int:
+        return HEADERS_FILE_HEADER.size + position * HEADER_RECORD.size
+
+    def append(self, header: BlockHeader):
+        """
+        Add the header of the next block. Raises ValueError if it is not
+        mined, or does not follow the last header.
+        """
+
+        if self.read_only:
+            raise ValueError("the header chain is read only")
+
+        if self._count > 0 and header.id != self.first_id + self._count:
+            raise ValueError(
+                f"header {header.id} does not follow header {self.tip_id()}"
+            )
+        if header.prev_hash.ljust(32, b"\0") != self._tip_hash:
+            raise ValueError(f"header {header.id} does not follow the last header")
+
+        header_hash = header.hash()
+        if not critc.meets_difficulty(header_hash, self.nibbles):
+            raise ValueError(f"header {header.id} is not mined")
+
+        pow = int.from_bytes(header.pow, "big")
+        if pow >= 1 << 64:
+            raise ValueError(f"the proof of work of header {header.id} is too big")
+
+        if self.first_id is None:
+            self.first_id = header.id
+            self._fp.seek(0)
+            self._fp.write(
+                HEADERS_FILE_HEADER.pack(HEADERS_MAGIC, HEADERS_VERSION, header.id)
+            )
+
+        self._fp.seek(self._record_offset(self._count))
+        self._fp.write(
+            HEADER_RECORD.pack(
+                header.merkle_root, header.timestamp, header.prev_hash, pow
+            )
+        )
+        self._count += 1
+        self._tip_hash = header_hash
+
+    def _header(self, position: int, record: tuple) -> BlockHeader:
+        root, timestamp, prev_hash, pow = record
+        return BlockHeader(
+            self.first_id + position, root, timestamp, prev_hash, int_to_bytes(pow)
+        )
+
+    def get_at(self, position: int) -> BlockHeader:
+        if position < 0:
+            position += self._count
+        if position < 0 or position >= self._count:
+            raise IndexError("header index out of range")
+
+        return self._header(position, HEADER_RECORD.unpack(self._read(position, 1)))
+
+    def _read(self, position: int, count: int) -> bytes:
+        """
+        Read count records, starting at position.
+        """
+
+        self._fp.flush()
+        return os.pread(
+            self._fp.fileno(),
+            count * HEADER_RECORD.size,
+            self._record_offset(position),
+        )
+
+    def get(self, id: int) -> BlockHeader:
+        """
+        Get the header of a block by its ID. Raises KeyError if it is not in
+        the chain.
+        """
+
+        if self.first_id is None or not 0 <= id - self.first_id < self._count:
+            raise KeyError(id)
+        return self.get_at(id - self.first_id)
+
+    def tip_id(self) -> int | None:
+        if self._count == 0:
+            return None
+        return self.first_id + self._count - 1
+
+    def tip_hash(self) -> bytes:
+        return self._tip_hash
+
+    def iter_from(self, position=0):
+        """
+        Go through the headers from position on, reading many at a time.
+        """
+
+        while position < self._count:
+            count = min(READ_HEADERS, self._count - position)
+            for record in HEADER_RECORD.iter_unpack(self._read(position, count)):
+                yield self._header(position, record)
+                position += 1
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def sync(self, source: "HeaderChain") -> int:
+        """
+        Add the headers another chain has after the ones this one has,
+        checking each of them. Returns how many were added.
+        """
+
+        start = 0
+        if self._count > 0:
+            if source.first_id != self.first_id:
+                raise ValueError("the header chains do not start at the same block")
+            start = self._count
+
+        added = 0
+        for header in source.iter_from(start):
+            self.append(header)
+            added += 1
+        return added
+
+    def sync_store(self, store: BlockStore) -> int:
+        """
+        Add the headers of the blocks in a block store after the ones this
+        chain has. This reads the whole blocks, so it is only for catching up
+        with a full node's own store. Returns how many were added.
+        """
+
+        tip_id = self.tip_id()
+        start = 0 if tip_id is None else store.position(tip_id) + 1
+
+        for position in range(start, len(store)):
+            self.append(store.get_at(position).header())
+        return len(store) - start
+
+    def flush(self, fsync=False):
+        if self.read_only:
+            return
+        self._fp.flush()
+        if fsync:
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        self.flush()
+        self._fp.close()
+
+    # allow using the chain in a with statement
+    def __enter__(self) -> "HeaderChain":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def validate_headers(
+    headers: HeaderChain, nibbles: int | None = None
+) -> ValidationResult:
+    """
+    Check every header in a header chain again: that it is mined and that it
+    follows the header before it. Only the headers are read.
+    """
+
+    if nibbles is None:
+        nibbles = headers.nibbles
+    n_bytes, mask = critc.difficulty_mask(nibbles)
+    sha256 = hashlib.sha256
+    pack = struct.Struct(HEADER_FORMAT).pack
+
+    # The records are checked straight from the file, without making a
+    # BlockHeader for each one, which is a lot faster.
+    prev = bytes(32)
+    id = headers.first_id
+
+    for position in range(0, len(headers), READ_HEADERS):
+        count = min(READ_HEADERS, len(headers) - position)
+        records = HEADER_RECORD.iter_unpack(headers._read(position, count))
+
+        for root, timestamp, prev_hash, pow in records:
+            if prev_hash != prev:
+                reason = "previous hash does not match the block before"
+                return ValidationResult(False, position, position, id, reason)
+
+            data = pack(id, root, timestamp, prev_hash, int_to_bytes(pow))
+            prev = sha256(data).digest()
+            if int.from_bytes(prev[:n_bytes], "big") & mask != 0:
+                reason = "proof of work does not meet the difficulty"
+                return ValidationResult(False, position, position, id, reason)
+
+            position += 1
+            id += 1
+
+    return ValidationResult(True, len(headers))
+
+
+class LightClient:
+    """
+    Class for a client that only keeps the headers of the chain. The body of
+    a block is only fetched from the block store of a full node when one of
+    its transactions is needed, and is checked against the header first.
+    """
+
+    def __init__(
+        self,
+        headers: HeaderChain,
+        bodies: BlockStore | None = None,
+        cache_size=BODY_CACHE_SIZE,
+    ):
+        self.headers = headers
+        self.bodies = bodies
+        self.cache_size = cache_size
+
+        # the bodies fetched most recently, newest last
+        self._cache = collections.OrderedDict()
+        self.fetched = 0  # how many bodies were fetched from the store
+
+    def block(self, id: int) -> Block:
+        """
+        Get a whole block, fetching its body if it is not cached. Raises
+        ValueError if the body does not match the header.
+        """
+
+        block = self._cache.get(id)
+        if block is not None:
+            self._cache.move_to_end(id)
+            return block
+
+        header = self.headers.get(id)
+        if self.bodies is None:
+            raise ValueError("the light client has no block store to fetch bodies from")
+
+        block = self.bodies.get(id)
+        self.fetched += 1
+        if block.merkle_root() != header.merkle_root or block.hash() != header.hash():
+            raise ValueError(f"the body of block {id} does not match its header")
+
+        self._cache[id] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)  # forget the oldest
+        return block
+
+    def transaction(self, block_id: int, position: int) -> Transaction:
+        return self.block(block_id).transactions[position]
+
+    def verify_transaction(
+        self, transaction: Transaction, block_id: int, proof: list[tuple[bytes, bool]]
+    ) -> bool:
+        """
+        Check that a transaction is in a block with a Merkle proof (see
+        Block.merkle_proof), without fetching the body of the block.
+        """
+
+        root = self.headers.get(block_id).merkle_root
+        return verify_merkle_proof(transaction, proof, root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check a critc.py header chain")
+    parser.add_argument("path", help="the header chain file")
+    parser.add_argument(
+        "--from", dest="store", help="add the headers of this block store first"
+    )
+    parser.add_argument("--nibbles", type=int, default=critc.NIBBLES)
+    args = parser.parse_args()
+
+    with HeaderChain(args.path, nibbles=args.nibbles) as headers:
+        if args.store is not None:
+            with BlockStore(args.store, read_only=True) as store:
+                added = headers.sync_store(store)
+            print(f"added {added} headers")
+
+        start = time.perf_counter()
+        res = validate_headers(headers, args.nibbles)
+        elapsed = time.perf_counter() - start
+
+    size = os.path.getsize(args.path)
+    if res.valid:
+        print(f"valid: {res.blocks} headers checked in {elapsed:.3f}s, {size} bytes")
+    else:
+        print(
+            f"invalid: block {res.invalid_id} (position {res.invalid_position}): {res.reason}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Indexes to find transactions in the blockchain made by critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# There are two indexes, kept in a directory:
+#
+#   - transactions.dat: one fixed size entry per transaction ID, with the ID
+#     of the block the transaction is in and its position in that block. The
+#     entry for a transaction is at (ID * entry size), so it is found straight
+#     away, in whatever order the transactions went into blocks. IDs that are
+#     not in any block (yet) have an empty entry.
+#   - postings.dat: for every name, the IDs of the transactions they sent or
+#     received, in pages of POSTINGS_PAGE_SIZE IDs. Each page points back to
+#     the page before it for the same name, so listing someone's transactions
+#     only reads their own pages.
+#
+# names.json says where each name's newest page is, how much of postings.dat
+# is complete, and the last block added. It is written (atomically) every
+# time the index is flushed, and pages written after that are dropped when
+# the index is opened again. Blocks added since then have to be added again,
+# which writes the same transaction entries again.
+
+import json
+import os
+import shutil
+import struct
+
+from critc import Block, write_atomic
+
+# one transaction entry: block ID + 1 (8 bytes, 0 for an empty entry) and
+# position in the block (4 bytes), big-endian
+TRANSACTION_ENTRY = struct.Struct(">QI")
+
+# how many transaction IDs each postings page holds
+POSTINGS_PAGE_SIZE = 64
+
+# a postings page: the offset of the page before it (or NO_PAGE), how many of
+# the IDs are used, then the IDs
+POSTINGS_PAGE = struct.Struct(f">QH{POSTINGS_PAGE_SIZE}Q")
+NO_PAGE = 0xFFFFFFFFFFFFFFFF
+
+TRANSACTIONS_NAME = "transactions.dat"
+POSTINGS_NAME = "postings.dat"
+NAMES_NAME = "names.json"
+
+
+class TransactionIndex:
+    """
+    Class to find which block a transaction is in, and every transaction
+    someone took part in, without going through the chain.
+    """
+
+    def __init__(self, path: str, fresh=False):
+        """
+        Open the index in the directory path, creating it if needed.
+        If fresh is True, anything already in it is deleted first.
+        """
+
+        if fresh and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+
+        # the ID of the last block that was added
+        self.tip_id = None
+
+        # for each name: (offset of their newest page in postings.dat or
+        # NO_PAGE, how many IDs are on pages)
+        self._pages: dict[str, tuple[int, int]] = {}
+
+        # IDs not written to a page yet, by name
+        self._pending: dict[str, list[int]] = {}
+
+        postings_size = 0
+
+        names_path = os.path.join(path, NAMES_NAME)
+        if os.path.exists(names_path):
+            with open(names_path) as fp:
+                d = json.load(fp)
+            self.tip_id = d["tip_id"]
+            self._pages = {name: tuple(page) for name, page in d["pages"].items()}
+            postings_size = d["postings_size"]
+
+        # Entries are written at their own place in transactions.dat, so it is
+        # opened without buffering, and without append mode.
+        transactions_path = os.path.join(path, TRANSACTIONS_NAME)
+        if not os.path.exists(transactions_path):
+            open(transactions_path, "wb").close()
+        self._transactions = open(transactions_path, "r+b", buffering=0)
+
+        # drop any pages written after names.json was last saved
+        self._postings = open(os.path.join(path, POSTINGS_NAME), "a+b")
+        self._postings.truncate(postings_size)
+
+    def add_block(self, block: Block):
+        """
+        Add the transactions of a new block to the indexes.
+        """
+
+        fd = self._transactions.fileno()
+        for position, transaction in enumerate(block.transactions):
+            os.pwrite(
+                fd,
+                TRANSACTION_ENTRY.pack(block.id + 1, position),
+                transaction.id * TRANSACTION_ENTRY.size,
+            )
+
+            self._add_posting(transaction.sender, transaction.id)
+            self._add_posting(transaction.receiver, transaction.id)
+
+        self.tip_id = block.id
+
+    def _add_posting(self, name: str, id: int):
+        pending = self._pending.setdefault(name, [])
+        pending.append(id)
+
+        if len(pending) == POSTINGS_PAGE_SIZE:
+            self._write_page(name)
+
+    def _write_page(self, name: str):
+        pending = self._pending.pop(name)
+        prev_page, on_pages = self._pages.get(name, (NO_PAGE, 0))
+
+        # the page is always full size, with the unused IDs set to 0
+        ids = pending + [0] * (POSTINGS_PAGE_SIZE - len(pending))
+
+        offset = self._postings.seek(0, os.SEEK_END)
+        self._postings.write(POSTINGS_PAGE.pack(prev_page, len(pending), *ids))
+        self._pages[name] = (offset, on_pages + len(pending))
+
+    def locate(self, id: int) -> tuple[int, int] | None:
+        """
+        Find a transaction: returns (block ID, position in the block),
+        or None if it is not in the index.
+        """
+
+        data = os.pread(
+            self._transactions.fileno(),
+            TRANSACTION_ENTRY.size,
+            id * TRANSACTION_ENTRY.size,
+        )
+        if len(data) < TRANSACTION_ENTRY.size:
+            return None  # past the end of the file
+
+        block_id, position = TRANSACTION_ENTRY.unpack(data)
+        if block_id == 0:
+            return None  # an empty entry
+        return block_id - 1, position
+
+    def clear(self):
+        """
+        Remove everything from the index, to add the blocks again from the start.
+        """
+
+        self._transactions.truncate(0)
+        self._postings.truncate(0)
+        self.tip_id = None
+        self._pages = {}
+        self._pending = {}
+        self.flush()
+
+    def transactions_of(self, name: str) -> list[int]:
+        """
+        Get the IDs of every transaction someone sent or received, in the
+        order they were added to the index.
+        """
+
+        self._postings.flush()
+
+        ids = []
+        page, _ = self._pages.get(name, (NO_PAGE, 0))
+
+        # the pages go from newest to oldest, so collect them backwards
+        pages = []
+        while page != NO_PAGE:
+            data = os.pread(self._postings.fileno(), POSTINGS_PAGE.size, page)
+            prev_page, used, *page_ids = POSTINGS_PAGE.unpack(data)
+            pages.append(page_ids[:used])
+            page = prev_page
+
+        for page_ids in reversed(pages):
+            ids.extend(page_ids)
+
+        ids.extend(self._pending.get(name, []))
+        return ids
+
+    def flush(self, fsync=False):
+        """
+        Write everything to the files, including the IDs that do not fill a
+        page yet, and save names.json.
+        """
+
+        for name in list(self._pending):
+            self._write_page(name)
+
+        self._postings.flush()
+        if fsync:
+            os.fsync(self._transactions.fileno())
+            os.fsync(self._postings.fileno())
+
+        d = {
+            "tip_id": self.tip_id,
+            "postings_size": self._postings.seek(0, os.SEEK_END),
+            "pages": self._pages,
+        }
+
+        # so names.json is never half written
+        write_atomic(os.path.join(self.path, NAMES_NAME), json.dumps(d), fsync)
+
+    def close(self):
+        self.flush()
+        self._transactions.close()
+        self._postings.close()
+
+    # allow using the index in a with statement
+    def __enter__(self) -> "TransactionIndex":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
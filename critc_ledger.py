@@ -0,0 +1,139 @@
+# Account balances for the blockchain made by critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Finding someone's balance from the chain means going through every
+# transaction in every block. The ledger does that once, as each block is
+# added, and keeps the totals by name, so a balance is just a dictionary lookup.
+
+import base64
+import collections
+import json
+
+from critc import Block, write_atomic
+
+# how many of the newest blocks can be rolled back
+ROLLBACK_DEPTH = 100
+
+
+class Ledger:
+    """
+    Class to keep the balance and the number of transactions of everyone
+    in the chain up to date as blocks are added.
+    """
+
+    def __init__(self, rollback_depth=ROLLBACK_DEPTH):
+        self.balances: dict[str, int] = {}
+        self.counts: dict[str, int] = {}  # number of transactions, sent or received
+
+        self.tip_id = None  # the ID and hash of the last block applied
+        self.tip_hash = bytes()
+
+        # What each of the newest blocks changed, to undo them with. Each item
+        # is (previous tip ID, previous tip hash, changes), where changes maps
+        # each name to (change in balance, change in count).
+        self._undo = collections.deque(maxlen=rollback_depth)
+
+    def apply_block(self, block: Block):
+        """
+        Add the transactions of a new block to the balances.
+        """
+
+        changes = {}
+        for transaction in block.transactions:
+            balance, count = changes.get(transaction.sender, (0, 0))
+            changes[transaction.sender] = (balance - transaction.amount, count + 1)
+
+            balance, count = changes.get(transaction.receiver, (0, 0))
+            changes[transaction.receiver] = (balance + transaction.amount, count + 1)
+
+        self._change(changes, 1)
+
+        self._undo.append((self.tip_id, self.tip_hash, changes))
+        self.tip_id = block.id
+        self.tip_hash = block.hash()
+
+    def _change(self, changes: dict, sign: int):
+        for name, (balance, count) in changes.items():
+            self.balances[name] = self.balances.get(name, 0) + balance * sign
+            self.counts[name] = self.counts.get(name, 0) + count * sign
+
+            # forget people who are back to having nothing at all
+            if self.counts[name] == 0:
+                del self.balances[name]
+                del self.counts[name]
+
+    def rollback(self, blocks=1):
+        """
+        Undo the newest blocks, for example when they are replaced by another
+        branch. Raises ValueError if asked to go back further than the
+        rollback depth allows.
+        """
+
+        if blocks > len(self._undo):
+            raise ValueError(
+                f"can only roll back {len(self._undo)} blocks, not {blocks}"
+            )
+
+        for _ in range(blocks):
+            self.tip_id, self.tip_hash, changes = self._undo.pop()
+            self._change(changes, -1)
+
+    def balance(self, name: str) -> int:
+        return self.balances.get(name, 0)
+
+    def transaction_count(self, name: str) -> int:
+        return self.counts.get(name, 0)
+
+    def to_dict(self) -> dict:
+        return {
+            "tip_id": self.tip_id,
+            "tip_hash": base64.b64encode(self.tip_hash).decode("utf-8"),
+            "balances": self.balances,
+            "counts": self.counts,
+            "rollback_depth": self._undo.maxlen,
+            "undo": [
+                {
+                    "prev_tip_id": prev_tip_id,
+                    "prev_tip_hash": base64.b64encode(prev_tip_hash).decode("utf-8"),
+                    "changes": changes,
+                }
+                for prev_tip_id, prev_tip_hash, changes in self._undo
+            ],
+        }
+
+    @staticmethod
+    def from_dict(d: dict) -> "Ledger":
+        ledger = Ledger(d["rollback_depth"])
+        ledger.tip_id = d["tip_id"]
+        ledger.tip_hash = base64.b64decode(d["tip_hash"])
+        ledger.balances = d["balances"]
+        ledger.counts = d["counts"]
+
+        for item in d["undo"]:
+            # JSON turns the (balance, count) tuples into lists, so turn them back
+            changes = {name: tuple(change) for name, change in item["changes"].items()}
+            ledger._undo.append(
+                (
+                    item["prev_tip_id"],
+                    base64.b64decode(item["prev_tip_hash"]),
+                    changes,
+                )
+            )
+
+        return ledger
+
+    def checkpoint(self, path: str):
+        """
+        Save the ledger to a file, which is never left half written.
+        """
+
+        write_atomic(path, json.dumps(self.to_dict()))
+
+    @staticmethod
+    def load(path: str) -> "Ledger":
+        with open(path) as fp:
+            return Ledger.from_dict(json.load(fp))
@@ -0,0 +1,589 @@
+# Writing the blocks.log file for critc.py, and reading it back
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# The log is a series of records like this:
+#
+#   Block 12
+#   =====================
+#   { ...the block as JSON, over many lines... }
+#
+# The file is read one line at a time, so reading a huge log does not need
+# much memory. It is written by LogWriter, on a thread of its own.
+#
+# The log can also be rotated: once it gets big enough, it is compressed into
+# a segment of a LogArchive, and started again empty. The archive has a
+# manifest with the block IDs in each segment, so reading some blocks back
+# only decompresses the segments they are in.
+
+import json
+import lzma
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+
+from critc import Block, write_atomic
+
+BANNER = re.compile(r"^Block (\d+)$")
+
+# a banner, as found when reading the log backwards from the end
+TAIL_BANNER = re.compile(rb"\nBlock (\d+)\n=+\n")
+
+# how much of the log to read at a time when reading it backwards
+READ_BACK_SIZE = 64 * 1024
+
+# how archive segments can be compressed: the ending of the file name, and
+# functions to compress and decompress
+COMPRESSIONS = {
+    "zlib": (".zz", zlib.compress, zlib.decompress),
+    "lzma": (".xz", lzma.compress, lzma.decompress),
+}
+
+MANIFEST_NAME = "manifest.json"
+
+
+def iter_log_records(fp):
+    """
+    Go through the records in an open log file, yielding the block ID from
+    each banner and the text of the block under it.
+    """
+
+    id = None
+    lines = []
+    prev_line = None  # a "Block N" line that may be the start of a banner
+
+    for line in fp:
+        line = line.rstrip("\n")
+
+        # a banner is a "Block N" line followed by a line of "="
+        if prev_line is not None:
+            if line != "" and line.strip("=") == "":
+                if id is not None:
+                    yield id, "\n".join(lines)
+                id = int(BANNER.match(prev_line).group(1))
+                lines = []
+                prev_line = None
+                continue
+
+            lines.append(prev_line)
+            prev_line = None
+
+        if BANNER.match(line):
+            prev_line = line
+        elif id is not None:
+            lines.append(line)
+
+    if prev_line is not None and id is not None:
+        lines.append(prev_line)
+    if id is not None:
+        yield id, "\n".join(lines)
+
+
+def logged_as_str(text: str) -> bool:
+    """
+    Check if the text of a record is a block logged with LOG_BLOCK_AS_STR.
+    """
+
+    # The string form starts with "{" too, but in JSON the next thing after
+    # it can only be a key in quotes, or "}" if there is nothing in it.
+    text = text.strip()
+    return text.startswith("{") and not text[1:].lstrip().startswith(('"', "}"))
+
+
+def parse_record(text: str) -> Block:
+    """
+    Turn the text of a record back into a block. Only blocks logged as JSON
+    can be read back, not ones logged with LOG_BLOCK_AS_STR.
+    """
+
+    if logged_as_str(text):
+        raise ValueError("blocks logged as strings cannot be read back")
+
+    return Block.from_json(text)
+
+
+def iter_log_blocks(fp):
+    """
+    Go through the blocks in an open log file.
+    """
+
+    for _, text in iter_log_records(fp):
+        yield parse_record(text)
+
+
+def last_record(fp) -> tuple[int, int] | None:
+    """
+    Find the last record in a log opened in binary mode, reading backwards
+    from the end so the rest of the file is not read. Returns the offset of
+    its banner and its block ID, or None if there are no records.
+    """
+
+    pos = fp.seek(0, os.SEEK_END)
+    data = bytes()
+
+    while pos > 0:
+        start = max(pos - READ_BACK_SIZE, 0)
+        fp.seek(start)
+        data = fp.read(pos - start) + data
+        pos = start
+
+        # a banner at the very start of the file has no newline before it
+        if pos == 0:
+            found = list(TAIL_BANNER.finditer(b"\n" + data))
+            skip = 0
+        else:
+            found = list(TAIL_BANNER.finditer(data))
+            skip = 1
+
+        if len(found) > 0:
+            match = found[-1]
+            return pos + match.start() + skip, int(match.group(1))
+
+    return None
+
+
+def trim_log(path: str, keep_id: int | None = None) -> int | None:
+    """
+    Get a log ready to be added to again: drop the records of blocks after
+    keep_id (if given), and anything only partly written when the program
+    stopped. Returns the ID of the last record left, or None if there are
+    none.
+
+    Only the end of the log is read, however long it is.
+    """
+
+    with open(path, "r+b") as fp:
+        while True:
+            res = last_record(fp)
+            if res is None:
+                return None
+
+            offset, id = res
+            if keep_id is not None and id > keep_id:
+                fp.truncate(offset)
+                continue
+
+            fp.seek(offset)
+            banner = fp.readline() + fp.readline()
+            text = fp.read().decode("utf-8")
+
+            if logged_as_str(text):
+                return id  # can't be checked, so keep it
+
+            # Find where the JSON of the block ends. Anything after it is
+            # the start of a record that was only partly written.
+            try:
+                _, end = json.JSONDecoder().raw_decode(text)
+            except json.JSONDecodeError:
+                fp.truncate(offset)  # the block itself is only partly written
+                continue
+
+            end = offset + len(banner) + len(text[:end].encode("utf-8"))
+            fp.truncate(end)
+            fp.seek(end)
+            fp.write(b"\n")
+            return id
+
+
+class LogArchive:
+    """
+    Class to keep old parts of the log compressed, in a directory of
+    segments with a manifest.json saying which block IDs each one has.
+    """
+
+    def __init__(self, path: str, compression="zlib"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown log compression: {compression}")
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compression = compression
+
+        # one dict per segment, oldest first: its file name, compression,
+        # first and last block IDs, and sizes before and after compressing
+        self.segments: list[dict] = []
+
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fp:
+                self.segments = json.load(fp)["segments"]
+
+    def last_id(self) -> int | None:
+        """
+        The ID of the last block in the archive, or None if it is empty.
+        """
+
+        if len(self.segments) == 0:
+            return None
+        return self.segments[-1]["last_id"]
+
+    def seal(self, text: str, first_id: int, last_id: int):
+        """
+        Compress some of the log into a new segment. The segment is written
+        before the manifest, and both are renamed into place, so a crash
+        leaves either the old archive or the new one.
+        """
+
+        ending, compress, _ = COMPRESSIONS[self.compression]
+        data = text.encode("utf-8")
+        compressed = compress(data)
+
+        name = f"segment-{len(self.segments):06d}.log{ending}"
+        self._write_file(name, compressed)
+
+        self.segments.append(
+            {
+                "name": name,
+                "compression": self.compression,
+                "first_id": first_id,
+                "last_id": last_id,
+                "size": len(data),
+                "compressed_size": len(compressed),
+            }
+        )
+        manifest = json.dumps({"segments": self.segments})
+        self._write_file(MANIFEST_NAME, manifest.encode("utf-8"))
+
+    def _write_file(self, name: str, data: bytes):
+        write_atomic(os.path.join(self.path, name), data)
+
+    def read_segment(self, segment: dict) -> str:
+        _, _, decompress = COMPRESSIONS[segment["compression"]]
+        with open(os.path.join(self.path, segment["name"]), "rb") as fp:
+            return decompress(fp.read()).decode("utf-8")
+
+    def iter_records(
+        self, start_id: int | None = None, stop_id: int | None = None
+    ):
+        """
+        Go through the records of the blocks from start_id to stop_id (both
+        included, and either can be None for no limit), yielding the block
+        ID and the text, like iter_log_records. Only the segments with those
+        blocks are decompressed.
+        """
+
+        for segment in self.segments:
+            if start_id is not None and segment["last_id"] < start_id:
+                continue
+            if stop_id is not None and segment["first_id"] > stop_id:
+                break
+
+            text = self.read_segment(segment)
+            for id, record in iter_log_records(text.splitlines(keepends=True)):
+                if start_id is not None and id < start_id:
+                    continue
+                if stop_id is not None and id > stop_id:
+                    break
+                yield id, record
+
+    def trim(self, keep_id: int):
+        """
+        Drop the records of blocks after keep_id, for when the block store
+        lost blocks that were already sealed. A segment with some blocks to
+        keep is written again with only those, before the manifest.
+        """
+
+        if self.last_id() is None or self.last_id() <= keep_id:
+            return
+
+        kept = [segment for segment in self.segments if segment["first_id"] <= keep_id]
+        dropped = self.segments[len(kept) :]
+
+        if len(kept) > 0 and kept[-1]["last_id"] > keep_id:
+            segment = kept[-1]
+            records = self.iter_records(segment["first_id"], keep_id)
+            text = "".join(
+                f"Block {id}\n=====================\n{record}\n"
+                for id, record in records
+            )
+            data = text.encode("utf-8")
+            compressed = COMPRESSIONS[segment["compression"]][1](data)
+            self._write_file(segment["name"], compressed)
+
+            segment["last_id"] = keep_id
+            segment["size"] = len(data)
+            segment["compressed_size"] = len(compressed)
+
+        self.segments = kept
+        manifest = json.dumps({"segments": self.segments})
+        self._write_file(MANIFEST_NAME, manifest.encode("utf-8"))
+
+        # only removed once the manifest no longer has them
+        for segment in dropped:
+            os.remove(os.path.join(self.path, segment["name"]))
+
+    def drop_sealed(self, log_path: str):
+        """
+        Empty the log if the archive already has its blocks. This happens if
+        the program stopped after sealing a segment but before emptying the
+        log.
+        """
+
+        last_id = self.last_id()
+        if last_id is None or not os.path.exists(log_path):
+            return
+
+        with open(log_path, "rb") as fp:
+            res = last_record(fp)
+        if res is not None and res[1] <= last_id:
+            os.truncate(log_path, 0)
+
+
+def iter_all_records(log_path: str, archive: LogArchive | None = None):
+    """
+    Go through the records of the archive (if there is one) and then the log.
+    """
+
+    last_id = None
+    if archive is not None:
+        for id, text in archive.iter_records():
+            yield id, text
+        last_id = archive.last_id()
+
+    with open(log_path) as fp:
+        for id, text in iter_log_records(fp):
+            if last_id is None or id > last_id:
+                yield id, text
+
+
+class LogWriter:
+    """
+    Class to write records to the log on a background thread, so that
+    waiting for the disk does not hold up mining.
+
+    Records are written in groups, and how often the file is flushed
+    depends on the policy:
+
+    - "block": flush after every record
+    - "group": flush after flush_every records, or once the oldest record
+      not flushed yet is flush_ms milliseconds old, whichever is first
+
+    With fsync, every flush also makes the operating system write the file
+    to the disk, so the records survive a power cut.
+
+    With metrics (see critc_metrics.py), how long writing and flushing take
+    and how many records are waiting are counted.
+
+    With an archive, the log is sealed into a new segment of the archive and
+    started again once it has rotate_size bytes or rotate_blocks records in
+    it (if they are not None). Sealing is done on the writer's thread too.
+    """
+
+    def __init__(
+        self,
+        fp,
+        policy="group",
+        flush_every=16,
+        flush_ms=200,
+        fsync=False,
+        queue_size=1024,
+        archive: LogArchive | None = None,
+        rotate_size: int | None = None,
+        rotate_blocks: int | None = None,
+        metrics=None,
+    ):
+        if policy not in ("block", "group"):
+            raise ValueError(f"unknown log flush policy: {policy}")
+
+        self.fp = fp
+        self.policy = policy
+        self.flush_every = flush_every
+        self.flush_ms = flush_ms
+        self.fsync = fsync
+
+        self.archive = archive
+        self.rotate_size = rotate_size
+        self.rotate_blocks = rotate_blocks
+
+        # the first and last block IDs in the log and its size, for rotating
+        self._first_id = None
+        self._last_id = None
+        self._size = 0
+        if archive is not None:
+            self._find_ids()
+
+        # records waiting to be written. Once it is full, write() waits for
+        # the thread to catch up instead of using more and more memory.
+        self._queue = queue.Queue(queue_size)
+        self._closed = False
+
+        self._write_time = None
+        self._flush_time = None
+        if metrics is not None:
+            self._write_time = metrics.histogram(
+                "log_write_seconds", "Seconds taken to write each record to the log."
+            )
+            self._flush_time = metrics.histogram(
+                "log_flush_seconds", "Seconds taken by each flush of the log."
+            )
+            metrics.gauge(
+                "log_queue_depth",
+                "Records waiting to be written to the log.",
+                self._queue.qsize,
+            )
+
+        # an error from the thread, raised again by the next write or close
+        self._error = None
+
+        # daemon, so a stuck disk can't stop the program from exiting
+        self._thread = threading.Thread(
+            target=self._run, name="log writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, record: str):
+        """
+        Send a record to be written. It returns straight away, unless
+        queue_size records are already waiting.
+        """
+
+        if self._closed:
+            raise ValueError("write to a closed log writer")
+        if self._error is not None:
+            raise self._error
+        self._queue.put(record)
+
+    def _flush(self):
+        if self._flush_time is not None:
+            start = time.perf_counter()
+
+        self.fp.flush()
+        if self.fsync:
+            os.fsync(self.fp.fileno())
+
+        if self._flush_time is not None:
+            self._flush_time.observe(time.perf_counter() - start)
+
+    def _find_ids(self):
+        # for a log that already has records in it
+        self._size = self.fp.seek(0, os.SEEK_END)
+        if self._size == 0:
+            return
+
+        self.fp.seek(0)
+        for id, _ in iter_log_records(self.fp):
+            self._first_id = id
+            break
+
+        with open(self.fp.name, "rb") as fp:
+            res = last_record(fp)
+        if res is not None:
+            self._last_id = res[1]
+
+    def _rotate_due(self) -> bool:
+        if self._first_id is None:
+            return False
+        if self.rotate_size is not None and self._size >= self.rotate_size:
+            return True
+        count = self._last_id - self._first_id + 1
+        return self.rotate_blocks is not None and count >= self.rotate_blocks
+
+    def _rotate(self):
+        """
+        Seal the log into the archive, and empty it.
+        """
+
+        self._flush()
+        self.fp.seek(0)
+        self.archive.seal(self.fp.read(), self._first_id, self._last_id)
+
+        self.fp.truncate(0)
+        self._flush()
+
+        self._first_id = None
+        self._last_id = None
+        self._size = 0
+
+    def _run(self):
+        try:
+            self._write_records()
+        except Exception as e:
+            self._error = e
+
+            # keep taking records, so write() does not wait forever on a full queue
+            while self._queue.get() is not None:
+                pass
+
+    def _write_records(self):
+        unflushed = 0
+        deadline = None  # when the unflushed records have to be flushed by
+
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+
+            try:
+                record = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                record = ""  # nothing new, but it is time to flush
+
+            if record is None:  # sent by close()
+                self._flush()
+                return
+
+            if record != "":
+                if self._write_time is None:
+                    self.fp.write(record)
+                else:
+                    start = time.perf_counter()
+                    self.fp.write(record)
+                    self._write_time.observe(time.perf_counter() - start)
+                unflushed += 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_ms / 1000
+
+                if self.archive is not None:
+                    id = int(BANNER.match(record[: record.index("\n")]).group(1))
+                    if self._first_id is None:
+                        self._first_id = id
+                    self._last_id = id
+                    self._size += len(record)
+
+                    if self._rotate_due():
+                        self._rotate()  # which flushes too
+                        unflushed = 0
+                        deadline = None
+                        continue
+
+            # Write everything already waiting before flushing, so that one
+            # flush covers as many records as possible.
+            if record != "" and not self._queue.empty() and self.policy == "group":
+                if unflushed < self.flush_every:
+                    continue
+
+            if unflushed == 0:
+                deadline = None
+                continue
+
+            if (
+                self.policy == "block"
+                or unflushed >= self.flush_every
+                or time.monotonic() >= deadline
+            ):
+                self._flush()
+                unflushed = 0
+                deadline = None
+
+    def close(self):
+        """
+        Write and flush everything that is left, then close the file.
+        Closing more than once does nothing.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(None)
+        self._thread.join()
+        self.fp.close()
+
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,186 @@
+# A pool of transactions waiting to be put in a block
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+
+import collections
+import heapq
+
+from critc import Transaction
+
+# the most transactions the pool holds
+MEMPOOL_SIZE = 10000
+
+# How transactions are picked for a block: "amount" picks the biggest amounts
+# first, "arrival" picks the ones that came first. When the pool is full, the
+# transaction that would be picked last is thrown away.
+POLICIES = ("amount", "arrival")
+
+
+class Mempool:
+    """
+    Class to hold transactions until they are put in a block.
+
+    It never holds more than capacity transactions, and it turns away any
+    transaction whose ID it already has or recently handed out for a block.
+    """
+
+    def __init__(self, capacity=MEMPOOL_SIZE, policy="amount"):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown mempool policy: {policy}")
+        if capacity < 1:
+            raise ValueError("the mempool must hold at least one transaction")
+
+        self.capacity = capacity
+        self.policy = policy
+
+        # the transactions in the pool, with the number they arrived as, by ID
+        self._entries: dict[int, tuple[Transaction, int]] = {}
+        self._arrivals = 0
+
+        # IDs recently handed out by select, so they are not taken again.
+        # An OrderedDict is used as a set that remembers its order, so the
+        # oldest can be forgotten once there are too many.
+        self._taken = collections.OrderedDict()
+
+        # Two heaps of (priority, arrival number, ID): one with the next
+        # transaction to pick on top, and one with the next to throw away on
+        # top. Removing from the middle of a heap is slow, so transactions
+        # are only removed from the pool, and skipped when they reach the
+        # top of a heap.
+        self._pick = []
+        self._evict = []
+
+        # counts, to see how the pool is doing
+        self.duplicates = 0
+        self.evicted = 0
+
+    def _priority(self, transaction: Transaction, arrival: int) -> int:
+        """
+        A number that is lower for transactions that should be picked first.
+        """
+
+        if self.policy == "amount":
+            return -transaction.amount
+        return arrival
+
+    def add(self, transaction: Transaction) -> bool:
+        """
+        Add a transaction to the pool. Returns False if it was turned away,
+        as a duplicate or because the pool is full of better transactions.
+        """
+
+        if transaction.id in self._entries or transaction.id in self._taken:
+            self.duplicates += 1
+            return False
+
+        arrival = self._arrivals
+        self._arrivals += 1
+        priority = self._priority(transaction, arrival)
+
+        if len(self._entries) >= self.capacity:
+            worst = self._top(self._evict)
+            worst_priority, worst_arrival, worst_id = worst
+
+            # the new one would be thrown away first, so don't add it
+            if (priority, arrival) >= (-worst_priority, -worst_arrival):
+                self.evicted += 1
+                return False
+
+            heapq.heappop(self._evict)
+            del self._entries[worst_id]
+            self.evicted += 1
+
+        self._entries[transaction.id] = (transaction, arrival)
+        heapq.heappush(self._pick, (priority, arrival, transaction.id))
+        heapq.heappush(self._evict, (-priority, -arrival, transaction.id))
+
+        self._compact()
+        return True
+
+    def _top(self, heap: list) -> tuple:
+        """
+        Get the top of a heap, first dropping items that left the pool.
+        """
+
+        while True:
+            item = heap[0]
+            entry = self._entries.get(item[2])
+
+            # the arrival number tells apart a transaction that left and came back
+            if entry is not None and entry[1] == abs(item[1]):
+                return item
+
+            heapq.heappop(heap)
+
+    def _compact(self):
+        # Rebuild the heaps once they are mostly transactions that already
+        # left, so they do not grow forever.
+        if len(self._pick) + len(self._evict) > 4 * len(self._entries) + 64:
+            self._pick = []
+            self._evict = []
+            for id, (transaction, arrival) in self._entries.items():
+                priority = self._priority(transaction, arrival)
+                self._pick.append((priority, arrival, id))
+                self._evict.append((-priority, -arrival, id))
+            heapq.heapify(self._pick)
+            heapq.heapify(self._evict)
+
+    def select(self, count: int) -> list[Transaction]:
+        """
+        Take up to count transactions out of the pool for a block, best first.
+        """
+
+        res = []
+        while len(res) < count and len(self._entries) > 0:
+            _, _, id = self._top(self._pick)
+            heapq.heappop(self._pick)
+            transaction, _ = self._entries.pop(id)
+            res.append(transaction)
+
+            self._taken[id] = None
+            if len(self._taken) > self.capacity:
+                self._taken.popitem(last=False)  # forget the oldest
+
+        self._compact()
+        return res
+
+    def remove(self, id: int) -> bool:
+        """
+        Take a transaction out of the pool without it going in a block here,
+        for example because it is already in a block from somewhere else.
+        It is turned away if it comes in later. Returns False if it was not
+        in the pool.
+        """
+
+        found = self._entries.pop(id, None) is not None
+
+        # it stays in the heaps until it reaches the top of them
+        self._taken[id] = None
+        if len(self._taken) > self.capacity:
+            self._taken.popitem(last=False)
+
+        self._compact()
+        return found
+
+    def restore(self, transaction: Transaction) -> bool:
+        """
+        Put back a transaction that was handed out for a block, for example
+        when the block is dropped from the chain. Returns False if it was
+        turned away, like add.
+        """
+
+        self._taken.pop(transaction.id, None)
+        return self.add(transaction)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def full(self) -> bool:
+        return len(self._entries) >= self.capacity
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._entries
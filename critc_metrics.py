@@ -0,0 +1,234 @@
+# Counting what critc.py does while it runs, for something else to read
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Metrics holds counters, gauges and histograms. A MetricsWriter writes them
+# to a file every few seconds, in the Prometheus text format or as JSON, so
+# a scraper (or a person) can read them while the miner runs.
+#
+# Nothing here is used inside the mining loop itself: the number of hashes
+# tried is worked out from the proof of work once a block is mined. When
+# metrics are turned off, critc.py only checks that they are None once per
+# block.
+
+import bisect
+import json
+import threading
+
+from critc import write_atomic
+
+# how often to write the metrics file, in seconds
+METRICS_INTERVAL = 5.0
+
+# buckets for histograms of how long something took, in seconds
+TIME_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# buckets for the number of hashes it took to mine a block
+ATTEMPT_BUCKETS = tuple(16**k for k in range(1, 9))
+
+
+class Counter:
+    """
+    Class for a number that only goes up, like the number of blocks mined.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    """
+    Class for a number that goes up and down, like the length of a queue.
+    With fn, the value is got by calling fn whenever the metrics are
+    written, so nothing has to keep it up to date.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+
+class Histogram:
+    """
+    Class to count how many values fell into each bucket, with the total of
+    the values, like how long each block took to mine. Each bucket counts
+    values up to and including its bound.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last is for bigger values
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def sample(self) -> dict:
+        # the count of each bucket includes all the buckets below it
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {
+            "buckets": dict(zip(bounds, cumulative)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class Metrics:
+    """
+    Class to hold all the metrics, by name.
+
+    The values are changed from the event loop and the log writer's thread,
+    and read from the metrics writer's thread, without locks. A value read
+    while it is being changed can be one update behind, which is fine for
+    metrics.
+    """
+
+    def __init__(self, prefix="critc_"):
+        self.prefix = prefix
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"there is already a metric called {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(self.prefix + name, help))
+
+    def gauge(self, name: str, help: str, fn=None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help, fn))
+
+    def histogram(self, name: str, help: str, buckets=TIME_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help, buckets))
+
+    def _items(self) -> list:
+        # a copy, as metrics can be added on another thread while writing
+        return list(self._metrics.items())
+
+    def __getitem__(self, name: str):
+        return self._metrics[self.prefix + name]
+
+    def to_dict(self) -> dict:
+        return {name: metric.sample() for name, metric in self._items()}
+
+    def to_prometheus(self) -> str:
+        """
+        Write the metrics in the Prometheus text format.
+        """
+
+        lines = []
+        for name, metric in self._items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+
+            value = metric.sample()
+            if metric.kind != "histogram":
+                lines.append(f"{name} {value}")
+                continue
+
+            for bound, count in value["buckets"].items():
+                lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{name}_sum {value['sum']}")
+            lines.append(f"{name}_count {value['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, format="prometheus"):
+        """
+        Write the metrics to a file, as "prometheus" text or "json". It is
+        written to a temporary file and renamed, so a reader never sees half
+        a file.
+        """
+
+        if format == "prometheus":
+            text = self.to_prometheus()
+        elif format == "json":
+            text = json.dumps(self.to_dict(), indent=4)
+        else:
+            raise ValueError(f"unknown metrics format: {format}")
+
+        # no fsync: a scraper reads it long before it matters if it is on the disk
+        write_atomic(path, text, fsync=False)
+
+
+class MetricsWriter:
+    """
+    Class to write the metrics to a file every interval seconds, on a
+    thread of its own.
+    """
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        path: str,
+        format="prometheus",
+        interval=METRICS_INTERVAL,
+    ):
+        if format not in ("prometheus", "json"):
+            raise ValueError(f"unknown metrics format: {format}")
+
+        self.metrics = metrics
+        self.path = path
+        self.format = format
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="metrics writer", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        # wait returns True once close() is called
+        while not self._stop.wait(self.interval):
+            self.metrics.write(self.path, self.format)
+
+    def close(self):
+        """
+        Stop the thread, and write the metrics one last time.
+        """
+
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.metrics.write(self.path, self.format)
@@ -0,0 +1,270 @@
+# Profiling each step of the critc.py pipeline, for a number of blocks
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Run critc.py with profiling turned on:
+#
+#   CRITC_PROFILE=50 python critc.py                 (the first 50 blocks)
+#   CRITC_PROFILE=50 CRITC_PROFILE_PATH=prof python critc.py
+#
+# Each step (stage) of handling a block is run under cProfile and
+# tracemalloc for the first few blocks. Then, for every stage, the calls are
+# written to <stage>.pstats (read it with "python -m pstats mine.pstats"),
+# and how long each stage took and where it allocated the most memory are
+# written to report.txt.
+#
+# Mining is done in another process, so it is profiled there and the results
+# are sent back (see profile_call). Both profilers make the code they watch
+# slower, mining most of all, so the times are higher than without them.
+
+import cProfile
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# the steps of handling a block, in the order they happen
+STAGES = ("mine", "apply", "to_str", "log_record", "log_write")
+
+# the environment variables that turn profiling on
+PROFILE_ENV = "CRITC_PROFILE"
+PROFILE_PATH_ENV = "CRITC_PROFILE_PATH"
+
+# how many allocation sites to list for each stage
+TOP_ALLOCATIONS = 15
+
+# how many frames tracemalloc keeps for each allocation
+TRACE_FRAMES = 1
+
+
+def blocks_from_env(default: int | None = None) -> int | None:
+    """
+    How many blocks to profile, from the CRITC_PROFILE environment variable,
+    or default if it is not set. 0 turns profiling off.
+    """
+
+    value = os.environ.get(PROFILE_ENV, "").strip()
+    if value == "":
+        return default
+
+    try:
+        blocks = int(value)
+    except ValueError:
+        raise ValueError(f"{PROFILE_ENV} must be a number of blocks, not {value!r}")
+    if blocks < 0:
+        raise ValueError(f"{PROFILE_ENV} can't be negative")
+    return blocks or None
+
+
+def path_from_env(default: str) -> str:
+    return os.environ.get(PROFILE_PATH_ENV, default)
+
+
+def _allocations(after, before=None) -> list[tuple[str, int, int]]:
+    """
+    The memory allocated between two tracemalloc snapshots (or since
+    tracemalloc was started, without before), as (where, bytes, count) for
+    each line, biggest first.
+    """
+
+    # leave out what tracemalloc and the profiler allocate themselves
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ]
+    after = after.filter_traces(filters)
+
+    if before is None:
+        stats = after.statistics("lineno")
+        return [(str(stat.traceback), stat.size, stat.count) for stat in stats]
+
+    stats = after.compare_to(before.filter_traces(filters), "lineno")
+    return [
+        (str(stat.traceback), stat.size_diff, stat.count_diff)
+        for stat in stats
+        if stat.size_diff > 0
+    ]
+
+
+@contextmanager
+def _traced(allocations: list):
+    """
+    Trace the memory allocated in the with block, and add where the memory
+    still allocated at the end of it was allocated to allocations.
+
+    tracemalloc only runs during the with block: tracing everything would
+    slow the whole program down, and a snapshot of everything takes long.
+    """
+
+    # if something else is tracing already, only count what is new
+    before = None
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(TRACE_FRAMES)
+    else:
+        before = tracemalloc.take_snapshot()
+
+    try:
+        yield
+        allocations.extend(_allocations(tracemalloc.take_snapshot(), before))
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+def profile_call(fn, args: tuple, trace_memory=True):
+    """
+    Call fn(*args) under cProfile (and tracemalloc, with trace_memory), for
+    running in another process. Returns what fn returned, the profile's
+    stats and the top allocation sites, which can all be sent back.
+
+    tracemalloc is for the whole process, so trace_memory must be False when
+    running on a thread while the stages are profiled on another one.
+    """
+
+    allocations = []
+    profile = cProfile.Profile()
+    if trace_memory:
+        with _traced(allocations):
+            res = profile.runcall(fn, *args)
+    else:
+        res = profile.runcall(fn, *args)
+
+    profile.create_stats()
+    return res, profile.stats, allocations[:TOP_ALLOCATIONS]
+
+
+class _SentStats:
+    """
+    What pstats.Stats needs to load stats sent back by profile_call.
+    """
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class StageProfiler:
+    """
+    Class to profile the first blocks calls of each stage, and write what
+    was found to a directory once every stage has had that many (or when it
+    is closed).
+    """
+
+    def __init__(self, path: str, blocks: int, stages=STAGES):
+        if blocks < 1:
+            raise ValueError("must profile at least one block")
+
+        self.path = path
+        self.blocks = blocks
+        self.stages = tuple(stages)
+
+        self._stats: dict[str, pstats.Stats] = {}
+        self._calls = dict.fromkeys(self.stages, 0)
+        self._seconds = dict.fromkeys(self.stages, 0.0)
+        # bytes and count allocated at each site, by stage
+        self._allocations = {stage: {} for stage in self.stages}
+        self._written = False
+
+    def wants(self, stage: str) -> bool:
+        """
+        Whether the next call of a stage should be profiled.
+        """
+
+        return not self._written and self._calls[stage] < self.blocks
+
+    @contextmanager
+    def stage(self, stage: str):
+        """
+        Profile the code in the with block as a call of stage, if it still
+        wants calls.
+        """
+
+        if not self.wants(stage):
+            yield
+            return
+
+        allocations = []
+        with _traced(allocations):
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - start
+
+        self._add(stage, profile, elapsed, allocations)
+
+    def add(self, stage: str, stats: dict, seconds: float, allocations: list):
+        """
+        Add a call of stage profiled in another process with profile_call.
+        """
+
+        if self.wants(stage):
+            self._add(stage, _SentStats(stats), seconds, allocations)
+
+    def _add(self, stage: str, profile, seconds: float, allocations: list):
+        if stage in self._stats:
+            self._stats[stage].add(profile)
+        else:
+            self._stats[stage] = pstats.Stats(profile)
+
+        self._calls[stage] += 1
+        self._seconds[stage] += seconds
+
+        sites = self._allocations[stage]
+        for where, size, count in allocations:
+            total = sites.setdefault(where, [0, 0])
+            total[0] += size
+            total[1] += count
+
+        if all(calls >= self.blocks for calls in self._calls.values()):
+            self.write()
+
+    def report(self) -> str:
+        lines = [f"profiled up to {self.blocks} blocks", ""]
+
+        for stage in self.stages:
+            calls = self._calls[stage]
+            seconds = self._seconds[stage]
+            mean = seconds / calls if calls > 0 else 0
+            lines.append(
+                f"{stage}: {calls} calls, {seconds:.6f}s, {mean * 1000:.3f}ms each"
+            )
+
+            sites = sorted(
+                self._allocations[stage].items(), key=lambda site: -site[1][0]
+            )
+            for where, (size, count) in sites[:TOP_ALLOCATIONS]:
+                lines.append(f"    {size:>12} bytes {count:>8} allocations  {where}")
+            lines.append("")
+
+        return "\n".join(lines)
+
+    def write(self):
+        """
+        Write a .pstats file for every stage that was called, and the report.
+        Only the first call does anything, and profiling stops after it.
+        """
+
+        if self._written:
+            return
+        self._written = True
+
+        os.makedirs(self.path, exist_ok=True)
+        for stage, stats in self._stats.items():
+            stats.dump_stats(os.path.join(self.path, f"{stage}.pstats"))
+
+        with open(os.path.join(self.path, "report.txt"), "w") as fp:
+            fp.write(self.report())
+
+    def close(self):
+        self.write()
@@ -0,0 +1,182 @@
+# Carrying on with a blockchain made by an earlier run of critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# With a block store, the store holds the chain, and blocks.log is brought in
+# line with it: records of blocks the store does not have are dropped, and
+# blocks the log is missing are logged again. Without a store, the chain is
+# read back from blocks.log (and its archive). Either way the blocks are read
+# one at a time, to rebuild the ledger and bring the transaction index up to
+# date.
+#
+# With a block store, the ledger can also come from a snapshot (see
+# critc_snapshot.py). Then only the blocks after it are read, unless the
+# index or the log are further behind.
+
+import collections
+import os
+from dataclasses import dataclass
+
+from critc import CHAIN_WINDOW, Block, log_record
+from critc_chain import Chain
+from critc_index import TransactionIndex
+from critc_ledger import Ledger
+from critc_log import LogArchive, iter_all_records, parse_record, trim_log
+from critc_snapshot import load_snapshot
+from critc_store import BlockStore
+
+
+@dataclass
+class ResumedChain:
+    """
+    Class to hold what is needed to carry on mining a chain.
+    """
+
+    # Without a block store, only the newest blocks are kept in memory, in a
+    # deque of at most window blocks, like a Chain keeps them.
+    blocks: Chain | collections.deque[Block]
+    ledger: Ledger
+    next_block_id: int
+    next_transaction_id: int
+
+    def tip(self) -> Block | None:
+        """
+        Get the newest block, or None if the chain is empty.
+        """
+
+        if len(self.blocks) == 0:
+            return None
+        return self.blocks[-1]
+
+
+def resume_chain(
+    log_path: str,
+    store: BlockStore | None = None,
+    index: TransactionIndex | None = None,
+    window=CHAIN_WINDOW,
+    snapshot_path: str | None = None,
+    archive: LogArchive | None = None,
+) -> ResumedChain:
+    """
+    Load the chain from the block store (or the log at log_path and its
+    archive, if there is no store), so that mining can carry on from its
+    newest block. The log is created if it does not exist. The snapshot at
+    snapshot_path is used, if there is one and there is a store.
+    """
+
+    if not os.path.exists(log_path):
+        open(log_path, "w").close()
+
+    # The store is only flushed every so often, but sealed segments are
+    # synced to the disk, so after a crash the archive can have blocks the
+    # store lost. They are mined again, so they are dropped from it.
+    if store is not None:
+        tip = store.tip()
+        tip_id = -1 if tip is None else tip.id
+        if archive is not None:
+            archive.trim(tip_id)
+
+    if archive is not None:
+        archive.drop_sealed(log_path)
+
+    if store is not None:
+        logged_id = trim_log(log_path, tip_id)
+        blocks = Chain(store, window)
+    else:
+        tip_id = logged_id = trim_log(log_path)
+        blocks = collections.deque(maxlen=window)
+
+    # the log may have just been sealed into the archive
+    if logged_id is None and archive is not None:
+        logged_id = archive.last_id()
+        if store is None:
+            tip_id = logged_id
+        elif logged_id is not None:
+            logged_id = min(logged_id, tip_id)
+
+    # An index that has blocks the chain does not (lost when the program
+    # stopped) can't have them taken out again, so it is made again instead.
+    if index is not None and index.tip_id is not None:
+        if tip_id is None or index.tip_id > tip_id:
+            index.clear()
+
+    if store is None:
+        return _resume_from_log(log_path, archive, blocks, index)
+
+    snapshot = None
+    if snapshot_path is not None:
+        snapshot = load_snapshot(snapshot_path, store)
+
+    if snapshot is not None:
+        ledger = snapshot["ledger"]
+        next_block_id = snapshot["next_block_id"]
+        next_transaction_id = snapshot["next_transaction_id"]
+    else:
+        ledger = Ledger()
+        next_block_id = 0
+        next_transaction_id = 0
+
+    def after(id: int | None) -> int:
+        # the position in the store of the block after the one with this ID
+        if id is None or id < 0:
+            return 0
+        return store.position(id) + 1
+
+    # start from the first block that the ledger, the index or the log needs
+    start = after(ledger.tip_id)
+    if index is not None:
+        start = min(start, after(index.tip_id))
+    start = min(start, after(logged_id))
+
+    with open(log_path, "a") as log:
+        for position in range(start, len(store)):
+            block = store.get_at(position)
+
+            if ledger.tip_id is None or block.id > ledger.tip_id:
+                ledger.apply_block(block)
+                next_block_id = block.id + 1
+                for transaction in block.transactions:
+                    next_transaction_id = max(next_transaction_id, transaction.id + 1)
+
+            if index is not None and (index.tip_id is None or block.id > index.tip_id):
+                index.add_block(block)
+
+            if logged_id is None or block.id > logged_id:
+                log.write(log_record(block))  # missing from the log
+
+    if index is not None:
+        index.flush()
+
+    return ResumedChain(blocks, ledger, next_block_id, next_transaction_id)
+
+
+def _resume_from_log(
+    log_path: str,
+    archive: LogArchive | None,
+    blocks: collections.deque[Block],
+    index: TransactionIndex | None,
+) -> ResumedChain:
+    ledger = Ledger()
+    next_transaction_id = 0
+
+    for _, text in iter_all_records(log_path, archive):
+        block = parse_record(text)
+        ledger.apply_block(block)
+        blocks.append(block)
+
+        if index is not None and (index.tip_id is None or block.id > index.tip_id):
+            index.add_block(block)
+
+        for transaction in block.transactions:
+            next_transaction_id = max(next_transaction_id, transaction.id + 1)
+
+    if index is not None:
+        index.flush()
+
+    res = ResumedChain(blocks, ledger, 0, next_transaction_id)
+    if res.tip() is not None:
+        res.next_block_id = res.tip().id + 1
+    return res
@@ -0,0 +1,269 @@
+# Running critc.py for a fixed number of blocks, the same way every time
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Run with:
+#
+#   python critc_run.py --blocks 200 --nibbles 4 --seed 1
+#   python critc_run.py --blocks 200 --format str --json > run.json
+#
+# This starts a new chain in a directory of its own (--dir, where the chain
+# of the last run is deleted first), runs the whole pipeline of critc.main()
+# until --blocks blocks are added, without printing anything, and then
+# prints a report: how long it took, blocks and transactions per second,
+# and how many bytes were written.
+#
+# The transactions come from a seeded random number generator and the blocks
+# get made up timestamps (see BLOCK_TIME in critc.py), so two runs with the
+# same arguments make exactly the same chain, and the report shows the hash
+# of its last block to check this. The mempool picks transactions in the
+# order they came ("arrival"), as otherwise what goes in each block would
+# depend on how fast the machine mines. (It never throws any away in the
+# pipeline: the producer waits while it is full.)
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import critc
+from critc_store import BlockStore
+
+# the timestamp of the genesis block; every block after it is one second later
+RUN_BLOCK_TIME = 1700000000.0
+
+# where the chain is made, by default
+RUN_PATH = "critc_run"
+
+
+def _size(path: str) -> int:
+    """
+    The size of a file, or of all the files in a directory.
+    """
+
+    if not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _written() -> dict[str, int]:
+    # everything critc.main() writes, in the directory it ran in
+    paths = {
+        "log": "blocks.log",
+        "archive": critc.LOG_ARCHIVE_PATH,
+        "store": critc.BLOCK_STORE_PATH,
+        "index": critc.INDEX_PATH,
+        "headers": critc.HEADERS_PATH,
+        "snapshot": critc.SNAPSHOT_PATH,
+    }
+    return {name: _size(path) for name, path in paths.items() if path is not None}
+
+
+def run(
+    blocks: int,
+    seed=0,
+    nibbles=critc.NIBBLES,
+    block_cap=critc.BLOCK_CAP,
+    block_format="json",
+    path=RUN_PATH,
+    engine=critc.MINING_ENGINE,
+    workers=critc.MINE_WORKERS,
+    profile_blocks: int | None = None,
+    metrics_path: str | None = None,
+    metrics_format="prometheus",
+    generate: int | None = None,
+) -> dict:
+    """
+    Make a new chain of blocks blocks (after the genesis block) in path with
+    critc.main(), and return a report on it.
+    """
+
+    if blocks < 1:
+        raise ValueError("must run for at least one block")
+    if block_format not in ("json", "str"):
+        raise ValueError(f"unknown block format: {block_format}")
+
+    critc.MAX_BLOCKS = blocks
+    critc.NIBBLES = nibbles
+    critc.BLOCK_CAP = block_cap
+    critc.LOG_BLOCK_AS_STR = block_format == "str"
+    critc.MINING_ENGINE = engine
+    critc.MINE_WORKERS = workers
+
+    # Make the transactions in batches with critc_gen.py, to load test. Plain
+    # Python is used, so the chain is the same with or without NumPy.
+    critc.GENERATE_TRANSACTIONS = generate
+    critc.GENERATE_NUMPY = False
+
+    # start again every time, the same way
+    critc.RESUME = False
+    critc.BLOCK_TIME = RUN_BLOCK_TIME
+    critc.DELAY = False
+    critc.MEMPOOL_POLICY = "arrival"
+    if critc.BLOCK_STORE_PATH is None:
+        critc.BLOCK_STORE_PATH = "blocks"  # the report is read from it
+
+    # nothing on the console
+    critc.PRINT_BLOCKS = False
+    critc.PRINT_TRANSACTIONS = False
+    critc.PRINT_NEW_BLOCKS = False
+    critc.PRINT_HASHES = False
+
+    # these are written where they were asked for, not in the run's directory
+    if profile_blocks is not None:
+        critc.PROFILE_BLOCKS = profile_blocks
+        critc.PROFILE_PATH = os.path.abspath(critc.PROFILE_PATH)
+    if metrics_path is not None:
+        critc.METRICS_PATH = os.path.abspath(metrics_path)
+        critc.METRICS_FORMAT = metrics_format
+
+    # with RESUME off, main() deletes the chain a last run left there
+    os.makedirs(path, exist_ok=True)
+
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        random.seed(seed)
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(critc.main())
+        elapsed = time.perf_counter() - start
+
+        # go through the chain that was made
+        transactions = 0
+        hashes = 0
+        with BlockStore(critc.BLOCK_STORE_PATH, read_only=True) as store:
+            height = len(store)
+            for position in range(height):
+                block = store.get_at(position)
+                transactions += len(block.transactions)
+                # the search starts at 1, so this is the number of hashes tried
+                hashes += int.from_bytes(block.pow, "big")
+            tip = store.tip()
+
+        written = _written()
+    finally:
+        os.chdir(cwd)
+
+    return {
+        "blocks": blocks,
+        "seed": seed,
+        "nibbles": nibbles,
+        "block_cap": block_cap,
+        "format": block_format,
+        "engine": engine,
+        "workers": workers,
+        "generate": generate,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "height": height,
+        "tip_id": tip.id,
+        "tip_hash": tip.hash().hex(),
+        "wall_seconds": round(elapsed, 4),
+        "transactions": transactions,
+        "hashes": hashes,
+        "blocks_per_sec": round(blocks / elapsed, 3),
+        "transactions_per_sec": round(transactions / elapsed, 3),
+        "hashes_per_sec": round(hashes / elapsed, 1),
+        "bytes_written": sum(written.values()),
+        "bytes_by_file": written,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="run critc.py for a fixed number of blocks"
+    )
+    parser.add_argument("--blocks", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nibbles", type=int, default=critc.NIBBLES)
+    parser.add_argument("--block-cap", type=int, default=critc.BLOCK_CAP)
+    parser.add_argument(
+        "--format",
+        choices=("json", "str"),
+        default="json",
+        help="how the blocks are written to blocks.log",
+    )
+    parser.add_argument("--dir", default=RUN_PATH, help="where to make the chain")
+    parser.add_argument(
+        "--engine", choices=sorted(critc.MINING_ENGINES), default=critc.MINING_ENGINE
+    )
+    parser.add_argument("--workers", type=int, default=critc.MINE_WORKERS)
+    parser.add_argument(
+        "--generate",
+        type=int,
+        metavar="BATCH",
+        help="make transactions BATCH at a time with critc_gen.py",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        metavar="BLOCKS",
+        help="profile the first BLOCKS blocks (see critc_profile.py)",
+    )
+    parser.add_argument("--metrics", help="file to write metrics to")
+    parser.add_argument(
+        "--metrics-format", choices=("prometheus", "json"), default="prometheus"
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the whole report as JSON"
+    )
+    args = parser.parse_args()
+
+    try:
+        report = run(
+            args.blocks,
+            args.seed,
+            args.nibbles,
+            args.block_cap,
+            args.format,
+            args.dir,
+            args.engine,
+            args.workers,
+            args.profile,
+            args.metrics,
+            args.metrics_format,
+            args.generate,
+        )
+    except ValueError as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+        return
+
+    print(
+        f"{report['blocks']} blocks, seed {report['seed']}, {report['nibbles']} "
+        f"nibbles, {report['block_cap']} block cap, {report['format']} log"
+    )
+    print(f"tip: block {report['tip_id']}, {report['tip_hash']}")
+    print(
+        f"throughput: {report['wall_seconds']}s, {report['blocks_per_sec']} blocks/s, "
+        f"{report['transactions_per_sec']} transactions/s, "
+        f"{report['hashes_per_sec']} hashes/s"
+    )
+    print(
+        f"written: {report['bytes_written']} bytes ("
+        + ", ".join(f"{name} {size}" for name, size in report["bytes_by_file"].items())
+        + ")"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+# Several miners of critc.py talking to each other over the network
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Run with:
+#
+#   python critc_sim.py --nodes 4 --duration 10
+#
+# Every node is a process of its own, listening on localhost. The nodes are
+# joined in a ring, each one to the next --peers nodes. Every node makes its
+# own transactions and mines its own blocks, and sends them to its peers,
+# which send anything new on to their peers (gossip), so everything reaches
+# every node.
+#
+# A message is a header (MESSAGE_HEADER) followed by a transaction or block
+# in the binary format (Transaction.to_bytes and Block.to_bytes). The header
+# has the node the transaction or block came from and when it was made, so
+# every node can tell how long it took to get there.
+#
+# Each node keeps every mined block it gets in a BlockTree (see
+# critc_tree.py), and mines on top of the branch with the most work. A block
+# that follows a block the node does not have is counted as an orphan until
+# that block arrives.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import queue
+import random
+import statistics
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+
+import critc
+from critc import Block, Transaction, TransactionBatch
+from critc_mempool import Mempool
+from critc_tree import BlockTree, Reorg
+
+# kind of message (1 byte), the node it came from (1 byte), when it was made
+# there (8 byte time.time()), and the length of what follows (4 bytes)
+MESSAGE_HEADER = struct.Struct(">BBdI")
+TRANSACTION_MESSAGE = 1
+BLOCK_MESSAGE = 2
+
+# node i listens on SIM_PORT + i
+SIM_PORT = 9100
+
+# how many nodes after it in the ring each node connects to
+SIM_PEERS = 2
+
+# how many transactions each node makes per second
+SIM_TRANSACTION_RATE = 50
+
+# how long the nodes get to start listening before they connect to each other
+START_DELAY = 1.0
+
+# how often to check that no node died while waiting for their stats, in seconds
+RESULT_POLL = 1.0
+
+
+def encode_message(kind: int, origin: int, made: float, payload: bytes) -> bytes:
+    return MESSAGE_HEADER.pack(kind, origin, made, len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[int, int, float, bytes]:
+    """
+    Read the next message: (kind, origin node, time made, payload).
+    """
+
+    kind, origin, made, length = MESSAGE_HEADER.unpack(
+        await reader.readexactly(MESSAGE_HEADER.size)
+    )
+    return kind, origin, made, await reader.readexactly(length)
+
+
+def ring_links(nodes: int, peers: int) -> set[tuple[int, int]]:
+    """
+    The pairs of nodes to connect, lowest first: every node and the next
+    peers nodes after it in the ring.
+    """
+
+    res = set()
+    for i in range(nodes):
+        for k in range(1, peers + 1):
+            j = (i + k) % nodes
+            if j != i:
+                res.add((min(i, j), max(i, j)))
+    return res
+
+
+def _search_range(
+    base: bytes, start: int, stop: int, nibbles: int, engine: str
+) -> int | None:
+    # run in the node's mining process
+    return critc.get_mining_engine(engine).search(base, start, stop, nibbles)
+
+
+@dataclass
+class NodeStats:
+    """
+    Class to hold what one node saw during the simulation.
+    """
+
+    node: int
+    mined: int = 0  # blocks this node mined that it added to its chain
+    accepted: int = 0  # blocks from other nodes added to the chain
+    stale: int = 0  # blocks that lost to one already at their height
+    orphans: int = 0  # blocks that follow a block this node does not have
+    switches: int = 0  # times the node moved to another branch (reorgs)
+    height: int = 0  # ID of the newest block in the chain
+    tip_hash: str = ""
+    confirmed: int = 0  # transactions in the chain after the genesis block
+    messages_sent: int = 0
+    bytes_sent: int = 0
+
+    # seconds from a block or transaction being made to getting here
+    block_latencies: list[float] = field(default_factory=list)
+    transaction_latencies: list[float] = field(default_factory=list)
+
+
+class Node:
+    """
+    Class for one miner in the simulation.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        nodes: int,
+        genesis: Block,
+        links: set[tuple[int, int]],
+        port=SIM_PORT,
+        transaction_rate=SIM_TRANSACTION_RATE,
+        nibbles=4,
+        block_cap=critc.BLOCK_CAP,
+        seed=0,
+    ):
+        self.index = index
+        self.nodes = nodes
+        self.port = port
+        self.transaction_rate = transaction_rate
+        self.nibbles = nibbles
+        self.block_cap = block_cap
+
+        # the nodes to connect to (the other end of the link connects to this one)
+        self.connect_to = [j for i, j in links if i == index]
+
+        self.tree = BlockTree(genesis, nibbles)
+        self.mempool = Mempool()
+        self.stats = NodeStats(index)
+
+        self._random = random.Random(seed * 1000 + index)
+        self._next_transaction = 0
+        self._peers: list[asyncio.StreamWriter] = []
+
+        # what this node already has, so nothing is handled or sent on twice
+        self._seen_transactions: set[int] = set()
+        self._seen_blocks: set[bytes] = set()
+
+        # IDs of transactions in blocks that were added to the chain, which
+        # the miner takes out of the block it is working on
+        self._confirmed: set[int] = set()
+
+    def make_transaction(self) -> Transaction:
+        # Every node makes different IDs: node i makes i, i + nodes,
+        # i + 2 * nodes... (ID 0 is the genesis block's transaction).
+        self._next_transaction += 1
+        id = self._next_transaction * self.nodes + self.index
+
+        sender, receiver = self._random.sample(critc.NAMES, 2)
+        return Transaction(id, sender, receiver, self._random.randint(0, 200))
+
+    async def broadcast(self, message: bytes, exclude=None):
+        """
+        Send a message to every peer, except exclude (the one it came from).
+        """
+
+        for writer in list(self._peers):
+            if writer is exclude:
+                continue
+            try:
+                writer.write(message)
+                await writer.drain()
+            except ConnectionError:
+                self._peers.remove(writer)  # the peer has gone
+                continue
+            self.stats.messages_sent += 1
+            self.stats.bytes_sent += len(message)
+
+    async def produce_transactions(self):
+        while True:
+            await asyncio.sleep(self._random.expovariate(self.transaction_rate))
+
+            transaction = self.make_transaction()
+            self._seen_transactions.add(transaction.id)
+            self.mempool.add(transaction)
+            await self.broadcast(
+                encode_message(
+                    TRANSACTION_MESSAGE, self.index, time.time(), transaction.to_bytes()
+                )
+            )
+
+    @property
+    def tip(self) -> Block:
+        return self.tree.tip.block
+
+    def apply_reorg(self, reorg: Reorg):
+        """
+        Update the mempool after the chain changed: the transactions of the
+        blocks taken off go back in, and the ones in the new blocks come out.
+        """
+
+        for block in reorg.added:
+            for transaction in block.transactions:
+                self.mempool.remove(transaction.id)
+                self._confirmed.add(transaction.id)
+
+        for block in reorg.removed:
+            for transaction in block.transactions:
+                if transaction.id not in self._confirmed:
+                    self.mempool.restore(transaction)
+
+    async def mine_blocks(self):
+        """
+        Task to mine blocks on top of the newest block. The proof of work is
+        searched a chunk at a time, and if a block from another node arrives
+        in between, mining starts again on top of that one.
+        """
+
+        loop = asyncio.get_running_loop()
+        transactions = []  # the transactions of the block being mined
+
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            while True:
+                tip = self.tip
+
+                # leave out what other nodes' blocks already have
+                transactions = [t for t in transactions if t.id not in self._confirmed]
+                self._confirmed.clear()
+                transactions += self.mempool.select(self.block_cap - len(transactions))
+
+                if len(transactions) == 0:
+                    await asyncio.sleep(0.05)
+                    continue
+
+                block = Block(
+                    tip.id + 1,
+                    TransactionBatch(transactions),
+                    time.time(),
+                    tip.hash(),
+                    bytes(),
+                )
+                base = block.header().to_bytes(include_pow=False)
+
+                pow = None
+                start = 0
+                while pow is None and self.tip is tip:
+                    stop = start + critc.MINE_CHUNK_SIZE
+                    pow = await loop.run_in_executor(
+                        pool,
+                        _search_range,
+                        base,
+                        start,
+                        stop,
+                        self.nibbles,
+                        critc.MINING_ENGINE,
+                    )
+                    start = stop
+
+                if self.tip is not tip:
+                    continue  # another node's block came first
+
+                block.pow = critc.int_to_bytes(pow)
+                self._seen_blocks.add(block.hash())
+                self.apply_reorg(self.tree.add(block))
+                self._confirmed.clear()
+                self.stats.mined += 1
+                transactions = []
+
+                await self.broadcast(
+                    encode_message(BLOCK_MESSAGE, self.index, time.time(), block.to_bytes())
+                )
+
+    async def handle_message(self, kind, origin, made, payload, writer):
+        if kind == TRANSACTION_MESSAGE:
+            transaction = Transaction.from_bytes(payload)
+            if transaction.id in self._seen_transactions:
+                return
+            self._seen_transactions.add(transaction.id)
+            self.stats.transaction_latencies.append(time.time() - made)
+
+            self.mempool.add(transaction)
+
+        elif kind == BLOCK_MESSAGE:
+            block = Block.from_bytes(payload)
+            block_hash = block.hash()
+            if block_hash in self._seen_blocks:
+                return
+            self._seen_blocks.add(block_hash)
+            self.stats.block_latencies.append(time.time() - made)
+
+            try:
+                reorg = self.tree.add(block)
+            except ValueError:
+                return  # not mined, or does not fit, so not passed on either
+
+            if reorg is not None:
+                if len(reorg.removed) > 0:
+                    self.stats.switches += 1
+                self.apply_reorg(reorg)
+                self.stats.accepted += len(reorg.added)
+            elif block_hash in self.tree:
+                self.stats.stale += 1  # on a branch with less work
+            else:
+                self.stats.orphans += 1
+
+        else:
+            return  # unknown kind of message
+
+        # pass it on to everyone else
+        await self.broadcast(encode_message(kind, origin, made, payload), exclude=writer)
+
+    async def read_peer(self, reader, writer):
+        self._peers.append(writer)
+        try:
+            while True:
+                kind, origin, made, payload = await read_message(reader)
+                await self.handle_message(kind, origin, made, payload, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # the peer has gone
+        finally:
+            if writer in self._peers:
+                self._peers.remove(writer)
+            writer.close()
+
+    async def connect(self, peer: int):
+        # keep trying for a while, in case the peer is not listening yet
+        for _ in range(50):
+            try:
+                reader, writer = await asyncio.open_connection(
+                    "127.0.0.1", self.port + peer
+                )
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f"node {self.index} could not connect to node {peer}")
+
+        return asyncio.create_task(self.read_peer(reader, writer))
+
+    async def run(self, start: float, duration: float) -> NodeStats:
+        """
+        Listen, connect to the peers at the start time, and mine for duration
+        seconds.
+        """
+
+        tasks = []
+
+        def accept(reader, writer):
+            tasks.append(asyncio.create_task(self.read_peer(reader, writer)))
+
+        server = await asyncio.start_server(accept, "127.0.0.1", self.port + self.index)
+
+        await asyncio.sleep(max(start - time.time(), 0))
+        for peer in self.connect_to:
+            tasks.append(await self.connect(peer))
+
+        tasks.append(asyncio.create_task(self.produce_transactions()))
+        tasks.append(asyncio.create_task(self.mine_blocks()))
+
+        await asyncio.sleep(duration)
+
+        server.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.stats.height = self.tip.id
+        self.stats.tip_hash = self.tip.hash().hex()
+
+        # count the transactions in the chain, leaving out the genesis block
+        for block in self.tree.chain()[1:]:
+            self.stats.confirmed += len(block.transactions)
+
+        return self.stats
+
+
+def run_node(
+    index: int,
+    nodes: int,
+    genesis: bytes,
+    links: set[tuple[int, int]],
+    options: dict,
+    start: float,
+    duration: float,
+    results: multiprocessing.Queue,
+):
+    """
+    The function each node process runs. The stats are put in results, or
+    the error if the node failed, so simulate does not wait for it forever.
+    """
+
+    try:
+        node = Node(index, nodes, Block.from_bytes(genesis), links, **options)
+        results.put(asdict(asyncio.run(node.run(start, duration))))
+    except Exception as e:
+        results.put({"node": index, "error": f"{type(e).__name__}: {e}"})
+        raise
+
+
+def _collect(processes: list, results: multiprocessing.Queue) -> list[dict]:
+    """
+    Get the stats of every node. Raises RuntimeError if a node failed, or
+    died without sending anything (for example, if it was killed).
+    """
+
+    stats = []
+    while len(stats) < len(processes):
+        try:
+            res = results.get(timeout=RESULT_POLL)
+        except queue.Empty:
+            sent = {s["node"] for s in stats}
+            for i, process in enumerate(processes):
+                if i not in sent and process.exitcode not in (None, 0):
+                    raise RuntimeError(
+                        f"node {i} died with exit code {process.exitcode}"
+                    )
+            continue
+
+        if "error" in res:
+            raise RuntimeError(f"node {res['node']} failed: {res['error']}")
+        stats.append(res)
+
+    return stats
+
+
+def percentiles(values: list[float]) -> dict:
+    if len(values) == 0:
+        return {"count": 0}
+
+    values = sorted(values)
+
+    def ms(p: float) -> float:
+        # the value p of the way along, in milliseconds
+        return round(values[min(int(p * len(values)), len(values) - 1)] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+        "p50_ms": ms(0.5),
+        "p95_ms": ms(0.95),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def simulate(
+    nodes=4,
+    duration=10.0,
+    peers=SIM_PEERS,
+    port=SIM_PORT,
+    transaction_rate=SIM_TRANSACTION_RATE,
+    nibbles=4,
+    block_cap=critc.BLOCK_CAP,
+    seed=0,
+) -> dict:
+    """
+    Run the simulation and report the propagation latencies and throughput
+    of the whole network.
+    """
+
+    if nodes < 1 or nodes > 255:
+        raise ValueError("there must be between 1 and 255 nodes")
+
+    # every node starts from the same genesis block
+    genesis = Block(0, [Transaction(0, "Jason", "James", 1)], 0.0, bytes(), bytes())
+    base = genesis.header().to_bytes(include_pow=False)
+    genesis.pow = critc.int_to_bytes(critc.find_pow(base, nibbles))
+
+    links = ring_links(nodes, peers)
+    options = {
+        "port": port,
+        "transaction_rate": transaction_rate,
+        "nibbles": nibbles,
+        "block_cap": block_cap,
+        "seed": seed,
+    }
+
+    results = multiprocessing.Queue()
+    start = time.time() + START_DELAY
+    processes = [
+        multiprocessing.Process(
+            target=run_node,
+            args=(i, nodes, genesis.to_bytes(), links, options, start, duration, results),
+        )
+        for i in range(nodes)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        stats = _collect(processes, results)
+    finally:
+        # stop the others if one failed
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    stats.sort(key=lambda s: s["node"])
+
+    # the chain that most nodes ended up with
+    tips = [s["tip_hash"] for s in stats]
+    best = max(stats, key=lambda s: (tips.count(s["tip_hash"]), s["height"]))
+
+    block_latencies = [x for s in stats for x in s["block_latencies"]]
+    transaction_latencies = [x for s in stats for x in s["transaction_latencies"]]
+    for s in stats:
+        del s["block_latencies"], s["transaction_latencies"]
+
+    return {
+        "nodes": nodes,
+        "peers": peers,
+        "links": len(links),
+        "duration": duration,
+        "nibbles": nibbles,
+        "height": best["height"],
+        "agreeing_nodes": tips.count(best["tip_hash"]),
+        "blocks_per_sec": round(best["height"] / duration, 3),
+        "transactions_per_sec": round(best["confirmed"] / duration, 3),
+        "messages_per_sec": round(sum(s["messages_sent"] for s in stats) / duration, 3),
+        "bytes_per_sec": round(sum(s["bytes_sent"] for s in stats) / duration, 3),
+        "stale_blocks": sum(s["stale"] for s in stats),
+        "orphan_blocks": sum(s["orphans"] for s in stats),
+        "switches": sum(s["switches"] for s in stats),
+        "block_latency": percentiles(block_latencies),
+        "transaction_latency": percentiles(transaction_latencies),
+        "per_node": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulate several critc.py miners")
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--peers", type=int, default=SIM_PEERS)
+    parser.add_argument("--port", type=int, default=SIM_PORT)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=SIM_TRANSACTION_RATE,
+        help="transactions per second made by each node",
+    )
+    parser.add_argument("--nibbles", type=int, default=4)
+    parser.add_argument("--block-cap", type=int, default=critc.BLOCK_CAP)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--json", action="store_true", help="print the whole report as JSON"
+    )
+    args = parser.parse_args()
+
+    try:
+        report = simulate(
+            args.nodes,
+            args.duration,
+            args.peers,
+            args.port,
+            args.rate,
+            args.nibbles,
+            args.block_cap,
+            args.seed,
+        )
+    except (ValueError, RuntimeError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+        return
+
+    print(f"{report['nodes']} nodes, {report['links']} links, {report['duration']}s")
+    print(
+        f"chain: {report['height']} blocks, {report['agreeing_nodes']} nodes agree, "
+        f"{report['stale_blocks']} stale, {report['orphan_blocks']} orphans, "
+        f"{report['switches']} branch switches"
+    )
+    print(
+        f"throughput: {report['blocks_per_sec']} blocks/s, "
+        f"{report['transactions_per_sec']} transactions/s, "
+        f"{report['messages_per_sec']} messages/s, {report['bytes_per_sec']} bytes/s"
+    )
+    for name in ("block_latency", "transaction_latency"):
+        lat = report[name]
+        if lat["count"] == 0:
+            print(f"{name.replace('_', ' ')}: none")
+            continue
+        print(
+            f"{name.replace('_', ' ')}: p50 {lat['p50_ms']}ms, p95 {lat['p95_ms']}ms, "
+            f"max {lat['max_ms']}ms ({lat['count']} received)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Snapshots of the state of critc.py, to restart quickly
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Rebuilding the ledger means going through every block in the chain. A
+# snapshot saves it every so often, with the hash of the block it is up to
+# and the next IDs to use, so a restart only has to go through the blocks
+# added after the snapshot.
+#
+# The block store and the transaction index are flushed when a snapshot is
+# taken, so they have everything the snapshot has. The index saves where its
+# pages are itself (see critc_index.py).
+
+import json
+import os
+import threading
+
+from critc import SNAPSHOT_EVERY, write_atomic
+from critc_index import TransactionIndex
+from critc_ledger import Ledger
+from critc_store import BlockStore
+
+# changed whenever what is in a snapshot changes, so old ones are not used
+SNAPSHOT_VERSION = 1
+
+
+def load_snapshot(path: str, store: BlockStore) -> dict | None:
+    """
+    Read the snapshot at path. Returns None if there is none, or if it is
+    not for the chain in the store (for example if the store lost the
+    newest blocks when the program stopped).
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as fp:
+        try:
+            d = json.load(fp)
+        except json.JSONDecodeError:
+            return None
+
+    if d.get("version") != SNAPSHOT_VERSION:
+        return None
+
+    ledger = Ledger.from_dict(d["ledger"])
+    if ledger.tip_id is None:
+        return None
+
+    # the block the snapshot is up to must be in the store, with the same hash
+    try:
+        position = store.position(ledger.tip_id)
+    except KeyError:
+        return None
+    if store.hash_at(position) != ledger.tip_hash:
+        return None
+
+    d["ledger"] = ledger
+    d["position"] = position
+    return d
+
+
+class Snapshotter:
+    """
+    Class to take snapshots every so often while blocks are mined.
+
+    Writing the file (and waiting for the disk) is done on a thread, so
+    mining carries on. If the last snapshot is still being written when the
+    next one is due, the new one is skipped.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        store: BlockStore,
+        index: TransactionIndex | None = None,
+        every=SNAPSHOT_EVERY,
+    ):
+        if every < 1:
+            raise ValueError("snapshots must be taken at least every block")
+
+        self.path = path
+        self.store = store
+        self.index = index
+        self.every = every
+
+        self._thread = None
+        self.skipped = 0  # how many snapshots were skipped
+
+    def due(self, block_id: int) -> bool:
+        return block_id % self.every == 0
+
+    def take(self, ledger: Ledger, next_transaction_id: int, wait=False):
+        """
+        Take a snapshot of the ledger, which must be up to the newest block in
+        the store. With wait, the snapshot is written before returning.
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            if not wait:
+                self.skipped += 1
+                return
+            self._thread.join()
+
+        self.store.flush()
+        if self.index is not None:
+            self.index.flush()
+
+        # The ledger is turned into text here, as it changes once mining
+        # carries on. Only writing it is left to the thread.
+        data = json.dumps(
+            {
+                "version": SNAPSHOT_VERSION,
+                "next_block_id": ledger.tip_id + 1,
+                "next_transaction_id": next_transaction_id,
+                "ledger": ledger.to_dict(),
+            }
+        )
+
+        if wait:
+            write_atomic(self.path, data)
+            return
+
+        self._thread = threading.Thread(
+            target=write_atomic, args=(self.path, data), name="snapshot writer"
+        )
+        self._thread.start()
+
+    def close(self):
+        """
+        Wait for the snapshot being written, if there is one.
+        """
+
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,529 @@
+# An indexed, append-only store for the blocks made by critc.py
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# The store is a directory with:
+#
+#   - segment files (segment-000000.dat, segment-000001.dat, ...), which hold
+#     the blocks in the binary format (Block.to_bytes) one after the other.
+#     Once a segment is bigger than SEGMENT_SIZE, a new one is started.
+#   - an index file (index.dat) with one fixed size entry per block, saying
+#     which segment the block is in, where, and how long it is.
+#   - a hash table file (hashes.dat), which gives the position of a block in
+#     the index from its hash (see HashTable).
+#
+# Blocks are added with their IDs going up, and normally without gaps, so the
+# index entry of a block is found by working out its position from its ID and
+# reading just that entry. The segments are read through mmap, so any block
+# can be fetched without reading the blocks around it, and without keeping
+# anything per block in memory.
+
+import collections
+import mmap
+import os
+import shutil
+import struct
+
+from critc import Block
+
+# how big a segment file can get before a new one is started, in bytes
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# how many segments to keep mapped into memory at once
+MAX_OPEN_SEGMENTS = 8
+
+# one index entry: block ID (8 bytes), block hash (32 bytes), segment number
+# (4 bytes), offset in the segment (8 bytes) and length (4 bytes), big-endian
+INDEX_ENTRY = struct.Struct(">Q32sIQI")
+
+INDEX_NAME = "index.dat"
+
+# the hash table file: how many blocks of the index it has (8 bytes), then
+# slots of the first 8 bytes of a block hash and the block's position + 1
+# (8 bytes, 0 for an empty slot), big-endian
+HASHES_HEADER = struct.Struct(">Q")
+HASH_SLOT = struct.Struct(">8sQ")
+
+# how many slots a new hash table has (a power of 2). It is made twice as big
+# whenever it gets half full.
+HASH_SLOTS = 1024
+
+# how many slots to read at once when making the hash table bigger
+HASH_READ_SLOTS = 4096
+
+HASHES_NAME = "hashes.dat"
+
+
+def segment_name(segment: int) -> str:
+    return f"segment-{segment:06}.dat"
+
+
+class HashTable:
+    """
+    Class for a hash table on disk, from block hashes to positions in the
+    store's index, so a block is found by its hash without reading the index.
+
+    A position goes in the first empty slot from the one picked by the start
+    of its hash, and a lookup checks the slots from there until an empty one.
+    Only the first 8 bytes of each hash are kept, so the positions found have
+    to be checked against the full hashes in the index.
+    """
+
+    def __init__(self, path: str, read_only=False):
+        """
+        Open the table at path. It is created if it does not exist, unless it
+        is read only, where it stays empty.
+        """
+
+        self.path = path
+        self.read_only = read_only
+
+        self._fp = None
+        self.slots = 0
+        self.count = 0  # how many blocks of the index are in the table
+
+        if not os.path.exists(path):
+            if not read_only:
+                self._fp = self._create(path, HASH_SLOTS)
+                self.slots = HASH_SLOTS
+            return
+
+        self._fp = open(path, "rb" if read_only else "r+b")
+        size = os.fstat(self._fp.fileno()).st_size
+        self.slots = (size - HASHES_HEADER.size) // HASH_SLOT.size
+        (self.count,) = HASHES_HEADER.unpack(
+            os.pread(self._fp.fileno(), HASHES_HEADER.size, 0)
+        )
+
+    @staticmethod
+    def _create(path: str, slots: int):
+        fp = open(path, "w+b")
+        fp.truncate(HASHES_HEADER.size + slots * HASH_SLOT.size)  # all empty
+        return fp
+
+    def _slot_offset(self, slot: int) -> int:
+        return HASHES_HEADER.size + slot * HASH_SLOT.size
+
+    def positions(self, block_hash: bytes):
+        """
+        The positions in the table whose hash starts like block_hash.
+        """
+
+        if self.slots == 0:
+            return
+
+        prefix = block_hash[:8]
+        slot = int.from_bytes(prefix, "big") & (self.slots - 1)
+        for _ in range(self.slots):
+            data = os.pread(self._fp.fileno(), HASH_SLOT.size, self._slot_offset(slot))
+            slot_prefix, position = HASH_SLOT.unpack(data)
+            if position == 0:
+                return  # an empty slot, so the hash is not in the table
+            if slot_prefix == prefix:
+                yield position - 1
+            slot = (slot + 1) & (self.slots - 1)
+
+    def _put(self, fd: int, slots: int, prefix: bytes, position: int):
+        # position is stored + 1 already
+        slot = int.from_bytes(prefix, "big") & (slots - 1)
+        while True:
+            offset = self._slot_offset(slot)
+            slot_prefix, slot_position = HASH_SLOT.unpack(
+                os.pread(fd, HASH_SLOT.size, offset)
+            )
+            if slot_position == 0:
+                os.pwrite(fd, HASH_SLOT.pack(prefix, position), offset)
+                return
+            if slot_prefix == prefix and slot_position == position:
+                return  # already added before the table was last flushed
+            slot = (slot + 1) & (slots - 1)
+
+    def add(self, block_hash: bytes, position: int):
+        """
+        Add the block at position in the index, which must be the next one
+        (the table's count).
+        """
+
+        if (self.count + 1) * 2 > self.slots:
+            self._grow()
+
+        self._put(self._fp.fileno(), self.slots, block_hash[:8], position + 1)
+        self.count = position + 1
+
+    def _grow(self):
+        """
+        Make the table twice as big. Its slots have the start of each hash,
+        which is all that is needed to put them in the new one.
+        """
+
+        slots = self.slots * 2
+        tmp_path = self.path + ".tmp"
+        new = self._create(tmp_path, slots)
+
+        fd = self._fp.fileno()
+        for first in range(0, self.slots, HASH_READ_SLOTS):
+            n = min(HASH_READ_SLOTS, self.slots - first)
+            data = os.pread(fd, n * HASH_SLOT.size, self._slot_offset(first))
+            for prefix, position in HASH_SLOT.iter_unpack(data):
+                if position != 0:
+                    self._put(new.fileno(), slots, prefix, position)
+
+        os.pwrite(new.fileno(), HASHES_HEADER.pack(self.count), 0)
+        new.flush()
+        os.fsync(new.fileno())
+        os.replace(tmp_path, self.path)  # renaming is atomic
+
+        self._fp.close()
+        self._fp = new
+        self.slots = slots
+
+    def flush(self, fsync=False):
+        """
+        Write how many blocks are in the table. Blocks added after this are
+        added again when the store is opened.
+        """
+
+        if self.read_only or self._fp is None:
+            return
+
+        os.pwrite(self._fp.fileno(), HASHES_HEADER.pack(self.count), 0)
+        if fsync:
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        self.flush()
+        if self._fp is not None:
+            self._fp.close()
+
+
+class BlockStore:
+    """
+    Class to store blocks on disk and get them back by ID, by position or by hash.
+
+    Blocks can only be added to the end, and each block's ID must be higher
+    than the one before it.
+    """
+
+    def __init__(self, path: str, fresh=False, read_only=False):
+        """
+        Open the store in the directory path, creating it if needed.
+        If fresh is True, anything already in it is deleted first.
+
+        A read only store does not change any files, so several processes
+        can read the same store at once.
+        """
+
+        if read_only and fresh:
+            raise ValueError("a read only store cannot be fresh")
+
+        if fresh and os.path.exists(path):
+            shutil.rmtree(path)
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.read_only = read_only
+
+        self._count = 0  # number of blocks
+        self._first_id = None
+        self._last_id = None
+        self._segment = 0  # the segment blocks are added to
+
+        # Positions in the index, by block ID. Only needed (and made) if there
+        # are gaps in the IDs, otherwise the position is worked out from the ID.
+        self._positions_by_id = None
+
+        # Positions in the index, by block hash, of the blocks that are not in
+        # the hash table. Only made (by a read only store) the first time a
+        # block is looked up by its hash.
+        self._positions_by_hash = None
+
+        # open mmaps of the segments, by segment number, least recently used first
+        self._maps = collections.OrderedDict()
+
+        index_path = os.path.join(path, INDEX_NAME)
+        self._index = open(index_path, "rb" if read_only else "a+b")
+        self._index_dirty = False  # whether there are writes that were not flushed
+        self._load_index()
+
+        self._hashes = HashTable(os.path.join(path, HASHES_NAME), read_only)
+        if not read_only:
+            self._load_hashes()
+
+        # open the last segment for adding to the end of
+        self._data = None
+        if not read_only:
+            self._data = open(self._segment_path(self._segment), "ab")
+        self._data_dirty = False
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, segment_name(segment))
+
+    def _segment_size(self, segment: int) -> int:
+        try:
+            return os.path.getsize(self._segment_path(segment))
+        except FileNotFoundError:
+            return 0
+
+    def _load_index(self):
+        size = os.fstat(self._index.fileno()).st_size
+        count = size // INDEX_ENTRY.size
+
+        # If the program was stopped half way through writing, the end of the
+        # index can be a partial entry, or point past the end of a segment.
+        # Those blocks were never fully written, so they are dropped.
+        while count > 0:
+            _, _, segment, offset, length = self._entry(count - 1)
+            if offset + length <= self._segment_size(segment):
+                break
+            count -= 1
+
+        if count * INDEX_ENTRY.size != size and not self.read_only:
+            self._index.truncate(count * INDEX_ENTRY.size)
+
+        self._count = count
+        if count == 0:
+            return
+
+        self._first_id = self._entry(0)[0]
+        self._last_id, _, self._segment, _, _ = self._entry(count - 1)
+
+        # the IDs go up, so they have no gaps if the last one is where it would be
+        if self._last_id - self._first_id != count - 1:
+            self._positions_by_id = {}
+            for position in range(count):
+                self._positions_by_id[self._entry(position)[0]] = position
+
+    def _load_hashes(self):
+        # Blocks dropped from the end of the index may still be in the table,
+        # which does not matter, as every position found is checked. Blocks
+        # added since the table was last flushed are added again.
+        self._hashes.count = min(self._hashes.count, self._count)
+        for position in range(self._hashes.count, self._count):
+            self._hashes.add(self._entry(position)[1], position)
+
+    def _entry(self, position: int) -> tuple[int, bytes, int, int, int]:
+        """
+        Read the index entry at position: (id, hash, segment, offset, length).
+        """
+
+        if self._index_dirty:
+            self._index.flush()
+            self._index_dirty = False
+
+        data = os.pread(
+            self._index.fileno(), INDEX_ENTRY.size, position * INDEX_ENTRY.size
+        )
+        return INDEX_ENTRY.unpack(data)
+
+    def _position(self, id: int) -> int:
+        if self._positions_by_id is not None:
+            return self._positions_by_id[id]
+
+        if self._count == 0 or id < self._first_id or id > self._last_id:
+            raise KeyError(id)
+        return id - self._first_id
+
+    def append(self, block: Block):
+        """
+        Add a block to the end of the store.
+        """
+
+        if self.read_only:
+            raise ValueError("cannot add blocks to a read only store")
+        if self._last_id is not None and block.id <= self._last_id:
+            raise ValueError(
+                f"block {block.id} is not after the last block ({self._last_id})"
+            )
+
+        data = block.to_bytes()
+
+        # start a new segment if this one is full
+        offset = self._data.tell()
+        if offset > 0 and offset + len(data) > SEGMENT_SIZE:
+            self._data.close()
+            self._segment += 1
+            self._data = open(self._segment_path(self._segment), "ab")
+            offset = 0
+
+        self._data.write(data)
+        self._data_dirty = True
+
+        block_hash = block.hash()
+        self._index.write(
+            INDEX_ENTRY.pack(block.id, block_hash, self._segment, offset, len(data))
+        )
+        self._index_dirty = True
+
+        # a gap in the IDs, so positions can't be worked out from them any more
+        if self._positions_by_id is None and self._last_id is not None:
+            if block.id != self._last_id + 1:
+                self._positions_by_id = {
+                    id: id - self._first_id for id in range(self._first_id, self._last_id + 1)
+                }
+
+        if self._positions_by_id is not None:
+            self._positions_by_id[block.id] = self._count
+        self._hashes.add(block_hash, self._count)
+
+        if self._first_id is None:
+            self._first_id = block.id
+        self._last_id = block.id
+        self._count += 1
+
+    def _read(self, segment: int, offset: int, length: int) -> bytes:
+        if segment == self._segment and self._data_dirty:
+            # the block may still be in the write buffer
+            self._data.flush()
+            self._data_dirty = False
+
+        m = self._maps.get(segment)
+
+        # the last segment keeps growing, so map it again if the block is past
+        # the end of the old map
+        if m is None or offset + length > len(m):
+            if m is not None:
+                m.close()
+            with open(self._segment_path(segment), "rb") as fp:
+                m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = m
+
+        self._maps.move_to_end(segment)
+        if len(self._maps) > MAX_OPEN_SEGMENTS:
+            _, oldest = self._maps.popitem(last=False)
+            oldest.close()
+
+        return m[offset : offset + length]
+
+    def _check_position(self, position: int) -> int:
+        if position < 0:
+            position += self._count  # count from the end, like a list
+        if position < 0 or position >= self._count:
+            raise IndexError("block store index out of range")
+        return position
+
+    def get_at(self, position: int) -> Block:
+        """
+        Get the block at a position (0 for the first block added, -1 for the last).
+        Raises IndexError if there is no block there.
+        """
+
+        _, _, segment, offset, length = self._entry(self._check_position(position))
+        return Block.from_bytes(self._read(segment, offset, length))
+
+    def get(self, id: int) -> Block:
+        """
+        Get a block by its ID. Raises KeyError if it is not in the store.
+        """
+
+        return self.get_at(self._position(id))
+
+    def get_by_hash(self, block_hash: bytes) -> Block:
+        """
+        Get a block by its hash. Raises KeyError if it is not in the store.
+
+        The block is found through the hash table. A read only store can't
+        add to the table, so the first time, it reads the index entries of
+        the blocks that are not in the table yet (usually only the blocks
+        added since it was last flushed, but every block in a store made
+        before there was a hash table).
+        """
+
+        for position in self._hashes.positions(block_hash):
+            if position < self._count and self._entry(position)[1] == block_hash:
+                return self.get_at(position)
+
+        if self._positions_by_hash is None:
+            self._positions_by_hash = {}
+            for position in range(self._hashes.count, self._count):
+                self._positions_by_hash[self._entry(position)[1]] = position
+
+        return self.get_at(self._positions_by_hash[block_hash])
+
+    def hash_at(self, position: int) -> bytes:
+        """
+        Get the hash of the block at a position, without reading the block.
+        """
+
+        return self._entry(self._check_position(position))[1]
+
+    def position(self, id: int) -> int:
+        """
+        Get the position of a block in the store by its ID. Raises KeyError
+        if it is not in the store.
+        """
+
+        return self._position(id)
+
+    def tip(self) -> Block | None:
+        """
+        Get the last block added, or None if the store is empty.
+        """
+
+        if self._count == 0:
+            return None
+        return self.get_at(-1)
+
+    def ids(self):
+        """
+        All the block IDs in the store, in the order they were added.
+        """
+
+        if self._positions_by_id is not None:
+            return list(self._positions_by_id)  # dicts keep the order keys were added in
+        if self._count == 0:
+            return range(0)
+        return range(self._first_id, self._last_id + 1)
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield self.get_at(position)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, id: int) -> bool:
+        try:
+            self._position(id)
+        except KeyError:
+            return False
+        return True
+
+    def flush(self, fsync=False):
+        """
+        Write everything to the files. With fsync, also make the operating
+        system write it to the disk, so it survives a power cut.
+        """
+
+        if self.read_only:
+            return
+
+        self._data.flush()
+        self._data_dirty = False
+        self._index.flush()
+        self._index_dirty = False
+        self._hashes.flush(fsync)
+
+        if fsync:
+            os.fsync(self._data.fileno())
+            os.fsync(self._index.fileno())
+
+    def close(self):
+        self.flush()
+        if self._data is not None:
+            self._data.close()
+        self._index.close()
+        self._hashes.close()
+        for m in self._maps.values():
+            m.close()
+        self._maps.clear()
+
+    # allow using the store in a with statement
+    def __enter__(self) -> "BlockStore":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
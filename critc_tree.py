@@ -0,0 +1,241 @@
+# A tree of blocks, for when more than one miner makes blocks
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# With several miners, two blocks can follow the same block, and each starts
+# a branch. The tree keeps every branch, by block hash, and the chain is the
+# branch with the most work: how many hashes it took to mine all its blocks,
+# on average. Every block of a given difficulty is the same amount of work,
+# so this is the longest branch, unless blocks are mined at different
+# difficulties.
+#
+# Moving to another branch (a reorganisation, or reorg) only goes back to
+# where the two branches split, so it takes as long as the branches are
+# since the split, not as long as the whole chain.
+
+from dataclasses import dataclass, field
+
+import critc
+from critc import Block
+
+
+def block_work(nibbles: int) -> int:
+    """
+    How many hashes it takes on average to mine a block whose hash starts
+    with nibbles zero nibbles.
+    """
+
+    return 16**nibbles
+
+
+@dataclass(slots=True, eq=False)
+class TreeNode:
+    """
+    Class for a block in the tree, with the block before it and the total
+    work of the branch up to and including it.
+    """
+
+    block: Block
+    hash: bytes
+    parent: "TreeNode | None"
+    height: int  # how many blocks come before it
+    work: int
+    children: list["TreeNode"] = field(default_factory=list)
+
+
+@dataclass
+class Reorg:
+    """
+    Class to hold how the chain changed when a block was added: the blocks
+    taken off the end (newest first) and the blocks put on (oldest first).
+    Just adding a block to the end is a reorg with nothing removed.
+    """
+
+    removed: list[Block]
+    added: list[Block]
+
+
+class BlockTree:
+    """
+    Class to keep every branch of a blockchain by block hash, and pick the
+    branch with the most work as the chain.
+
+    Blocks that arrive before the block they follow are kept aside until it
+    arrives.
+    """
+
+    def __init__(self, genesis: Block, nibbles: int | None = None):
+        if nibbles is None:
+            nibbles = critc.NIBBLES
+        self.nibbles = nibbles
+
+        root = TreeNode(genesis, genesis.hash(), None, 0, block_work(nibbles))
+        self.root = root
+        self.tip = root
+        self._nodes: dict[bytes, TreeNode] = {root.hash: root}
+
+        # blocks waiting for the block they follow, by its hash
+        self._orphans: dict[bytes, list[Block]] = {}
+
+    def __contains__(self, block_hash: bytes) -> bool:
+        return block_hash in self._nodes
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def get(self, block_hash: bytes) -> Block:
+        """
+        Get a block by its hash. Raises KeyError if it is not in the tree.
+        """
+
+        return self._nodes[block_hash].block
+
+    def orphans(self) -> int:
+        """
+        How many blocks are waiting for the block before them.
+        """
+
+        return sum(len(blocks) for blocks in self._orphans.values())
+
+    def add(self, block: Block) -> Reorg | None:
+        """
+        Add a mined block. Returns how the chain changed, or None if it did
+        not (the block is on a branch with less work, or waits for the block
+        before it). Raises ValueError if the block is not mined or does not
+        fit after the block before it.
+        """
+
+        block_hash = block.hash()
+        if block_hash in self._nodes:
+            return None
+
+        if not block.check_pow(self.nibbles):
+            raise ValueError(f"block {block.id} is not mined")
+
+        parent = self._nodes.get(block.prev_hash)
+        if parent is None:
+            self._orphans.setdefault(block.prev_hash, []).append(block)
+            return None
+
+        best = self._attach(parent, block, block_hash)
+        if best.work <= self.tip.work:
+            return None  # the first branch found keeps a tie
+
+        return self._switch(best)
+
+    def _attach(self, parent: TreeNode, block: Block, block_hash: bytes) -> TreeNode:
+        """
+        Put a block in the tree, then any orphans waiting for it. Returns the
+        new node with the most work.
+        """
+
+        best = None
+        waiting = [(parent, block, block_hash)]
+
+        while len(waiting) > 0:
+            parent, block, block_hash = waiting.pop()
+
+            if block.id != parent.block.id + 1:
+                if best is None:
+                    raise ValueError(
+                        f"block {block.id} can't follow block {parent.block.id}"
+                    )
+                continue  # a bad orphan, just drop it
+
+            node = TreeNode(
+                block,
+                block_hash,
+                parent,
+                parent.height + 1,
+                parent.work + block_work(self.nibbles),
+            )
+            parent.children.append(node)
+            self._nodes[block_hash] = node
+
+            if best is None or node.work > best.work:
+                best = node
+
+            for child in self._orphans.pop(block_hash, []):
+                waiting.append((node, child, child.hash()))
+
+        return best
+
+    def _switch(self, new_tip: TreeNode) -> Reorg:
+        """
+        Make new_tip the end of the chain, going back only as far as where it
+        and the old chain split.
+        """
+
+        old = self.tip
+        new = new_tip
+        removed = []
+        added = []
+
+        while old.height > new.height:
+            removed.append(old.block)
+            old = old.parent
+        while new.height > old.height:
+            added.append(new.block)
+            new = new.parent
+        while old is not new:
+            removed.append(old.block)
+            added.append(new.block)
+            old = old.parent
+            new = new.parent
+
+        added.reverse()
+        self.tip = new_tip
+        return Reorg(removed, added)
+
+    def chain(self, count: int | None = None) -> list[Block]:
+        """
+        The blocks of the chain, oldest first. With count, only the newest
+        count blocks.
+        """
+
+        res = []
+        node = self.tip
+        while node is not None and (count is None or len(res) < count):
+            res.append(node.block)
+            node = node.parent
+
+        res.reverse()
+        return res
+
+    def prune(self, keep: int):
+        """
+        Forget blocks more than keep blocks before the end of the chain, and
+        the branches that split off before that, so the tree does not keep
+        growing. Branches that split later than that are kept.
+        """
+
+        root = self.tip
+        for _ in range(keep):
+            if root.parent is None:
+                return
+            root = root.parent
+
+        if root is self.root:
+            return
+
+        # keep what is after the new root
+        nodes = {}
+        waiting = [root]
+        while len(waiting) > 0:
+            node = waiting.pop()
+            nodes[node.hash] = node
+            waiting.extend(node.children)
+
+        root.parent = None
+        self.root = root
+        self._nodes = nodes
+
+        # orphans that can only follow a forgotten block can never be added
+        self._orphans = {
+            prev_hash: blocks
+            for prev_hash, blocks in self._orphans.items()
+            if all(block.id > root.block.id for block in blocks)
+        }
@@ -0,0 +1,286 @@
+# Checking a whole blockchain made by critc.py, on several processes at once
+#
+# This source code form is wholly licensed under the MIT/expat license.
+# Visit the OSI or FSF websites for more information.
+#
+# Copyright (c) Eason Qin, 2024.
+#
+# Run with:
+#
+#   python critc_validate.py blocks        (a block store directory)
+#   python critc_validate.py blocks.log    (a log written as JSON)
+#   python critc_validate.py blocks.log --archive blocks_archive
+#
+# Every block must be mined (its hash starts with NIBBLES zero nibbles), and
+# its previous hash must be the hash of the block before it. The chain is
+# split into chunks which are checked on different processes. Each chunk
+# reports the previous hash of its first block and the hash of its last
+# block, so the links between chunks can be checked without hashing again.
+
+import argparse
+import collections
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import critc
+from critc_log import LogArchive, iter_all_records, parse_record
+from critc_store import BlockStore
+
+# how many blocks each process checks at a time
+CHUNK_SIZE = 2000
+
+
+@dataclass
+class ValidationResult:
+    """
+    Class to hold the result of checking a chain. If it is not valid, the
+    first invalid block is given by its position in the chain and its ID.
+    """
+
+    valid: bool
+    blocks: int  # how many blocks were checked
+    invalid_position: int | None = None
+    invalid_id: int | None = None
+    reason: str = ""
+
+
+@dataclass
+class ChunkResult:
+    """
+    Class to hold the result of checking one chunk of the chain.
+    bad is (position, id, reason) for the first invalid block in the chunk.
+    """
+
+    start: int
+    count: int
+    first_id: int | None
+    first_prev_hash: bytes
+    last_hash: bytes
+    bad: tuple[int, int, str] | None
+
+
+def check_blocks(blocks, start: int, nibbles: int) -> ChunkResult:
+    """
+    Check the blocks of one chunk, which starts at position start in the chain.
+    """
+
+    count = 0
+    first_id = None
+    first_prev_hash = bytes()
+    last_hash = None
+    bad = None
+
+    for position, block in enumerate(blocks, start):
+        if count == 0:
+            first_id = block.id
+            first_prev_hash = block.prev_hash
+
+        if not block.check_pow(nibbles):
+            bad = (position, block.id, "proof of work does not meet the difficulty")
+            break
+
+        if last_hash is not None and block.prev_hash != last_hash:
+            bad = (position, block.id, "previous hash does not match the block before")
+            break
+
+        last_hash = block.hash()
+        count += 1
+
+    return ChunkResult(start, count, first_id, first_prev_hash, last_hash, bad)
+
+
+# Stores opened by this process, by path, so that a worker process does not
+# open the store again for every chunk.
+_stores = {}
+
+
+def check_store_chunk(path: str, start: int, stop: int, nibbles: int) -> ChunkResult:
+    store = _stores.get(path)
+    if store is None:
+        store = BlockStore(path, read_only=True)
+        _stores[path] = store
+
+    blocks = (store.get_at(position) for position in range(start, stop))
+    return check_blocks(blocks, start, nibbles)
+
+
+def check_log_chunk(
+    records: list[tuple[int, str]], start: int, nibbles: int
+) -> ChunkResult:
+    """
+    Check a chunk of (ID, text) log records. A record that can't be turned
+    back into a block is reported as invalid, after the blocks before it.
+    """
+
+    blocks = []
+    for id, text in records:
+        try:
+            blocks.append(parse_record(text))
+        except (ValueError, KeyError, TypeError) as e:
+            res = check_blocks(blocks, start, nibbles)
+            if res.bad is None:
+                res.bad = (start + len(blocks), id, f"cannot be read: {e}")
+            return res
+
+    return check_blocks(blocks, start, nibbles)
+
+
+def store_chunks(path: str, chunk_size: int, nibbles: int):
+    """
+    Split a store into chunks: yields the function to check each chunk with
+    and its arguments.
+    """
+
+    with BlockStore(path, read_only=True) as store:
+        count = len(store)
+
+    for start in range(0, count, chunk_size):
+        yield check_store_chunk, (path, start, min(start + chunk_size, count), nibbles)
+
+
+def log_chunks(
+    path: str, chunk_size: int, nibbles: int, archive: LogArchive | None = None
+):
+    """
+    Split a log (after its archive, if it has one) into chunks, reading it as
+    it goes. The text of each block is sent to the worker processes, which
+    turn it back into blocks.
+    """
+
+    start = 0
+    records = []
+
+    for id, text in iter_all_records(path, archive):
+        records.append((id, text))
+        if len(records) == chunk_size:
+            yield check_log_chunk, (records, start, nibbles)
+            start += len(records)
+            records = []
+
+    if len(records) > 0:
+        yield check_log_chunk, (records, start, nibbles)
+
+
+def combine(results) -> ValidationResult:
+    """
+    Go through the chunk results in order, checking the links between the
+    chunks, and stop at the first invalid block.
+    """
+
+    blocks = 0
+    last_hash = None
+
+    for res in results:
+        # the link between this chunk and the one before it
+        if last_hash is not None and res.first_id is not None:
+            if res.first_prev_hash != last_hash:
+                return ValidationResult(
+                    False,
+                    blocks,
+                    res.start,
+                    res.first_id,
+                    "previous hash does not match the block before",
+                )
+
+        blocks += res.count
+
+        if res.bad is not None:
+            position, id, reason = res.bad
+            return ValidationResult(False, blocks, position, id, reason)
+
+        if res.last_hash is not None:
+            last_hash = res.last_hash
+
+    return ValidationResult(True, blocks)
+
+
+def run_chunks(chunks, workers: int):
+    """
+    Check the chunks on a pool of processes, and yield the results in order.
+
+    Only a few chunks are sent at once, so that a huge log is not read into
+    memory all at once while the workers catch up.
+    """
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+
+        try:
+            for fn, args in chunks:
+                pending.append(pool.submit(fn, *args))
+
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            # if the caller stopped early (an invalid block), drop the rest
+            for future in pending:
+                future.cancel()
+
+
+def validate_chain(
+    path: str,
+    nibbles: int | None = None,
+    workers: int | None = None,
+    chunk_size=CHUNK_SIZE,
+    archive_path: str | None = None,
+) -> ValidationResult:
+    """
+    Check a whole chain, from a block store (if path is a directory) or a
+    log file, with the log archive at archive_path if there is one. nibbles
+    defaults to critc.NIBBLES, and workers to the number of CPUs. With 1
+    worker, everything is checked in this process.
+    """
+
+    if nibbles is None:
+        nibbles = critc.NIBBLES
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if os.path.isdir(path):
+        chunks = store_chunks(path, chunk_size, nibbles)
+    else:
+        archive = None
+        if archive_path is not None:
+            archive = LogArchive(archive_path)
+        chunks = log_chunks(path, chunk_size, nibbles, archive)
+
+    if workers == 1:
+        results = (fn(*args) for fn, args in chunks)
+        return combine(results)
+
+    results = run_chunks(chunks, workers)
+    try:
+        return combine(results)
+    finally:
+        results.close()  # stops the pool
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check a critc.py blockchain")
+    parser.add_argument("path", help="a block store directory or a JSON blocks.log")
+    parser.add_argument("--nibbles", type=int, default=critc.NIBBLES)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--archive", help="the archive of the log, if it is rotated")
+    args = parser.parse_args()
+
+    res = validate_chain(
+        args.path, args.nibbles, args.workers, args.chunk_size, args.archive
+    )
+
+    if res.valid:
+        print(f"valid: {res.blocks} blocks checked")
+    else:
+        print(
+            f"invalid: block {res.invalid_id} (position {res.invalid_position}): {res.reason}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()